@@ -0,0 +1,174 @@
+# coding: utf8
+
+# Symbols whose events are fetched, stored and re-adjusted together.
+BATCH_SIZE = 50
+
+DIVIDEND = "DIVIDEND"
+SPLIT = "SPLIT"
+
+
+def event_factors(events, prices):
+    """Price multiplier of every event, for all prices before its date.
+
+    Dividends use 1 - dividend / close of the previous trading day.
+    Splits are kept with a factor of 1: Yahoo's `Close` is already split
+    adjusted, so applying them again would count every split twice.
+    """
+    import numpy as np
+    import pandas as pd
+
+    events = events.sort_values("date").reset_index(drop=True)
+    prior = pd.merge_asof(
+        events[["symbol", "date"]],
+        prices.sort_values("date")[["symbol", "date", "close"]],
+        on="date", by="symbol", allow_exact_matches=False,
+    )
+
+    factor = pd.Series(1.0, index=events.index)
+    dividend = (events["action"] == DIVIDEND).values
+    prev_close = prior["close"].values
+    with np.errstate(invalid="ignore", divide="ignore"):
+        div_factor = 1.0 - events["value"].values / prev_close
+    ok = dividend & np.isfinite(div_factor) & (div_factor > 0)
+    factor[ok] = div_factor[ok]
+
+    events["factor"] = factor.values
+    return events
+
+
+def adjusted_close(prices, events):
+    """`prices` (symbol, date, close) with an `adj_close` column added.
+
+    Each close is multiplied by the product of the factors of all later
+    events of its symbol: a reverse cumulative product over the events,
+    matched to every price with a forward asof merge.
+    """
+    import pandas as pd
+
+    prices = prices.sort_values("date").reset_index(drop=True)
+    if events is None or not len(events):
+        prices["adj_close"] = prices["close"]
+        return prices
+
+    # Several events on one day act as one.
+    daily = events.groupby(["symbol", "date"])["factor"].prod().reset_index()
+    daily = daily.sort_values(["symbol", "date"], ascending=[True, False])
+    daily["cumulative"] = daily.groupby("symbol")["factor"].cumprod()
+    daily = daily.sort_values("date")[["symbol", "date", "cumulative"]]
+    daily = daily.rename(columns={"date": "event_date"})
+
+    merged = pd.merge_asof(
+        prices, daily, left_on="date", right_on="event_date", by="symbol",
+        direction="forward", allow_exact_matches=False,
+    )
+    merged["adj_close"] = merged["close"] * merged["cumulative"].fillna(1.0)
+    return merged.drop(columns=["event_date", "cumulative"])
+
+
+def _to_datetime(df, column="date"):
+    import pandas as pd
+
+    df[column] = pd.to_datetime(df[column])
+    return df
+
+
+def fetch_events(mf_scraper, symbols, start_dates, end_date):
+    """Distributions and splits for `symbols` as one frame."""
+    import pandas as pd
+
+    frames = []
+    for symbol in symbols:
+        df = mf_scraper.scrape_actions(symbol, start_dates[symbol], end_date)
+        if df is None or not len(df):
+            continue
+        df = df.reset_index()
+        df.columns = [c.lower() for c in df.columns]
+        df = df.rename(columns={"index": "date"})
+        df["symbol"] = symbol
+        frames.append(df[["symbol", "date", "action", "value"]])
+
+    if not frames:
+        return None
+    events = pd.concat(frames, ignore_index=True)
+    events["action"] = events["action"].str.upper()
+    return _to_datetime(events)
+
+
+def update_adjusted_prices(mf_scraper, symbols, batch_size=BATCH_SIZE):
+    """Fetch new events and bring `adjusted_prices` up to date.
+
+    Event lookups follow the same trading calendar as prices, so a
+    symbol is only asked for events once per published NAV. Symbols with
+    new events are re-adjusted over their whole history, all others only
+    get their not yet adjusted rows.
+    """
+    from market_calendar import latest_nav_date, schedule_refresh
+
+    db = mf_scraper.db
+    symbols = list(symbols)
+    last_lookups = db.last_event_lookups(symbols)
+    due = schedule_refresh(symbols, last_lookups, mf_scraper.start_date)
+
+    for i in range(0, len(symbols), batch_size):
+        batch = symbols[i:i + batch_size]
+        batch_due = [s for s in batch if s in due]
+
+        events = None
+        if batch_due:
+            events = fetch_events(mf_scraper, batch_due, due,
+                                  mf_scraper.end_date)
+
+        # Events, the lookup log and the adjusted rows are written in one
+        # transaction. A failed adjustment then also rolls back the
+        # events, so the next run sees them as new again.
+        with db.transaction():
+            # Splits stored while they were still applied.
+            changed = db.reset_event_factors(batch, SPLIT)
+            if events is not None:
+                prices = _to_datetime(
+                    db.prices_frame(events["symbol"].unique()))
+                events = event_factors(events, prices)
+                changed |= db.insert_events(events)
+
+            full = [s for s in batch if s in changed]
+            partial = [s for s in batch if s not in changed]
+
+            if batch_due:
+                db.log_event_lookups(batch_due, latest_nav_date())
+            if full:
+                _adjust(db, full, full_history=True, new_events=events)
+            if partial:
+                _adjust(db, partial, full_history=False)
+
+
+def _adjust(db, symbols, full_history, new_events=None):
+    """Write adjusted closes for `symbols`.
+
+    The db is read through this thread's reader, which doesn't see the
+    open transaction yet, so `new_events` written in it are passed along.
+    """
+    import pandas as pd
+
+    prices = db.prices_frame(symbols, unadjusted_only=not full_history)
+    if not len(prices):
+        return
+    prices = _to_datetime(prices)
+
+    events = db.events_frame(symbols)
+    if len(events):
+        events = _to_datetime(events)
+    if new_events is not None:
+        new_events = new_events[new_events["symbol"].isin(symbols)]
+        if len(events):
+            events = pd.concat([events, new_events], ignore_index=True)
+            events = events.drop_duplicates(["symbol", "date", "action"])
+        else:
+            events = new_events
+    if len(events):
+        # Only dividends move the split adjusted close, and the reader
+        # may still see split factors reset in the open transaction.
+        events = events[events["action"] == DIVIDEND]
+
+    adjusted = adjusted_close(prices, events)
+    adjusted["date"] = adjusted["date"].dt.strftime("%Y-%m-%d %H:%M:%S")
+    db.replace_adjusted(symbols if full_history else [], adjusted)
@@ -0,0 +1,147 @@
+# coding: utf8
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sqlite3
+from urllib.parse import quote
+
+import numpy as np
+
+# Below this many families the pool costs more than it saves.
+PARALLEL_MIN_FAMILIES = 50
+
+# Julian day of 1970-01-01, dates become the same day numbers as numpy's.
+UNIX_EPOCH_JULIAN_DAY = 2440587.5
+
+
+def family_arrays(df):
+    """Day numbers and closes of a family's price frame, NaNs dropped."""
+    import pandas as pd
+
+    dates = pd.to_datetime(df["date"]).values.astype("datetime64[D]")
+    days = dates.astype(np.int64)
+    close = df["close"].values.astype(np.float64)
+    keep = ~np.isnan(close)
+    return days[keep], close[keep]
+
+
+def daily_arrays(dbh, families, column="close_mean"):
+    """family -> (day numbers, closes) straight from family_daily_averages.
+
+    Dates are turned into day numbers by sqlite and the rows go into
+    numpy as is, without a DataFrame or any date parsing in between.
+    """
+    families = list(families)
+    out = dict()
+    # Stay under sqlite's limit on bound parameters.
+    for i in range(0, len(families), 500):
+        chunk = families[i:i + 500]
+        query = (
+            "SELECT fund_family, "
+            "CAST(julianday(substr(date, 1, 10)) - {epoch} AS INTEGER), "
+            "{column} "
+            "FROM family_daily_averages "
+            "WHERE fund_family IN ({ph}) AND {column} IS NOT NULL "
+            "ORDER BY fund_family, date"
+        ).format(epoch=UNIX_EPOCH_JULIAN_DAY, column=column,
+                 ph=",".join(["?"] * len(chunk)))
+        curr = dbh.cursor()
+        curr.execute(query, chunk)
+        rows = curr.fetchall()
+        curr.close()
+        if not rows:
+            continue
+
+        keys, days, close = zip(*rows)
+        keys = np.array(keys, dtype=object)
+        days = np.array(days, dtype=np.int64)
+        close = np.array(close, dtype=np.float64)
+        # Rows are ordered by family, cut where the family changes.
+        bounds = np.concatenate((
+            [0], np.flatnonzero(keys[1:] != keys[:-1]) + 1, [len(keys)]
+        ))
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            out[keys[start]] = (days[start:stop], close[start:stop])
+    return out
+
+
+def growth_rate(days, close):
+    """Growth of the daily average close from the first to the last day.
+
+    Both the serial and the parallel ranking go through here so that they
+    agree to the last bit.
+    """
+    if not len(days):
+        return np.nan
+    _, inverse = np.unique(days, return_inverse=True)
+    sums = np.bincount(inverse, weights=close)
+    counts = np.bincount(inverse)
+    first = sums[0] / counts[0]
+    last = sums[-1] / counts[-1]
+    if not first:
+        return np.nan
+    return (last - first) / first
+
+
+def _shard(families, n):
+    """Spread families over `n` shards, round robin."""
+    shards = [families[i::n] for i in range(n)]
+    return [s for s in shards if s]
+
+
+def _connect(db_path):
+    uri = "file:{}?mode=ro".format(quote(os.path.abspath(db_path)))
+    return sqlite3.connect(uri, uri=True)
+
+
+def _shard_growth_rates(db_path, families, column):
+    """Runs in a worker: read, convert and rank one shard of families."""
+    dbh = _connect(db_path)
+    try:
+        arrays = daily_arrays(dbh, families, column=column)
+    finally:
+        dbh.close()
+    return [(k, growth_rate(*arrays[k])) for k in families if k in arrays]
+
+
+def serial_growth_rates(arrays):
+    return [(k, growth_rate(*a)) for k, a in arrays.items()]
+
+
+def parallel_growth_rates(db_path, families, column="close_mean",
+                          processes=None):
+    """Growth rates of `families` from the db at `db_path`.
+
+    Every worker opens its own read only connection and does the whole
+    job for its shard, fetching, converting and ranking, so only family
+    names go in and (family, growth rate) pairs come out.
+    """
+    processes = processes or os.cpu_count() or 1
+    shards = _shard(list(families), processes)
+
+    rates = dict()
+    with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+        futures = [
+            pool.submit(_shard_growth_rates, db_path, shard, column)
+            for shard in shards
+        ]
+        for f in futures:
+            rates.update(f.result())
+    return rates
+
+
+def family_growth_rates(db, families, column="close_mean", processes=None):
+    """family -> growth rate of its materialized daily averages.
+
+    Families without any rows are left out.
+    """
+    families = list(families)
+    serial = (
+        processes == 1
+        or len(families) < PARALLEL_MIN_FAMILIES
+        or db.path == ":memory:"
+    )
+    if serial:
+        arrays = daily_arrays(db.reader(), families, column=column)
+        return dict(serial_growth_rates(arrays))
+    return parallel_growth_rates(db.path, families, column=column,
+                                 processes=processes)
@@ -1,222 +1,173 @@
 # coding: utf8
 import argparse
-from bs4 import BeautifulSoup
-
-import dash
-import dash_core_components as dcc
-import dash_html_components as html
-import dash_table_experiments as dt
-
-from dash.dependencies import Input, Output
-
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
-
-import re
-import requests
+import os
 import sys
-import plotly.graph_objs as go
-from urllib.error import HTTPError
-import time
 
 from scraper import MFScraper
 
 from utils import (
     cache_path,
-    df_weekly_to_quarterly,
     get_start_and_end_dates,
-    load_pickled_page,
-    pickled_page_exists,
-    pickle_response,
-    clean_df,
 )
 
 SLEEP_INTERVAL = 0.5
 
 
-def get_app(header, mf_scraper):
-    app = dash.Dash(sharing=True, csrf_protect=False)
+def get_mf_scraper(limit, db_path, processes=None, db=None, adjusted=False):
 
-    # inital layout
-    app.layout = get_app_layout(header, mf_scraper)
+    ds = "yahoo"
+    cache_name = cache_path()
 
-    @app.callback(
-        Output("graph-mf", "figure"),
-        [Input("ff-id", "value")])
-    def update_figure(selected_family):
+    # 7 day cache expiration.
+    start_date, end_date = get_start_and_end_dates()
+    mf_scraper = MFScraper(db_path, ds, cache_name, 7, start_date, end_date,
+                           limit=limit, processes=processes, db=db,
+                           adjusted=adjusted)
+    return mf_scraper
 
-        color_green = "#088c31"
-        color_red = "#FC6955"
 
-        selected_ff = mf_scraper.fund_families[selected_family]
-        selected_df = selected_ff["prices"]
+def logit(dataframes):
+    l = len(dataframes)
+    if l % 10 == 0:
+        symbol = dataframes[-1].ix[0].symbol
+        msg="{d} {s}: grabbed stats on {l} symbols".format(d=datetime.now(), s=symbol, l=l)
+        print(msg)
 
-        selected_df = mf_scraper.winners_losers(selected_df)
 
-        sorted_symbols = []
-        for s in selected_df.symbol.unique():
-           gr = selected_df[selected_df.symbol == s]["growth_rate"].values[0]
-           sorted_symbols.append((gr, s))
+def run_list(args):
+    mf_scraper = get_mf_scraper(args.limit, args.db)
+    print("All Fund Families Available:")
+    for ff in mf_scraper.list_all_fund_families():
+        print(ff)
 
-        sorted_symbols.sort(key=lambda x: x[0], reverse=True)
 
-        funds = []
-        for gr, i in sorted_symbols:
-            df_symbol = selected_df[selected_df.symbol == i]
+def run_refresh(args):
+    mf_scraper = get_mf_scraper(args.limit, args.db,
+                                adjusted=args.adjusted)
+    mf_scraper.run_all(rediscover=args.rediscover)
+    print("done grabbing dataframes.")
 
-            winner = selected_df[selected_df.symbol == i]["winner"].values[0]
-            if winner[0] == "w":
-                color = color_green
-            else:
-                color = color_red
 
-            funds.append(
-                go.Scatter(
-                    x=df_symbol["date"],
-                    y=df_symbol["close"],
-                    text=df_symbol["name_x"] + "<br>" + df_symbol["winner"],
-                    mode="lines",
-                    name=i,
-                    marker=dict(
-                        color=color
-                    ),
-                )
-            )
-        return {
-            "data": funds,
-            "layout": time_series_layout(),
-        }
+def start_refresher(mf_scraper, args):
+    """Refresh prices every `--refresh-every` minutes while serving.
 
-    return app
+    The refresher writes through the same DB as the Dash callbacks read
+    from. The families, their ranking and the ranked series are all
+    rebuilt on a separate scraper first, then swapped in together.
+    """
+    import threading
+    import time
 
-def get_mf_scraper(limit, db_path):
+    from dashboard import load_mf_scraper_with_df
 
-    ds = "yahoo"
-    cache_name = cache_path()
+    def refresh():
+        while True:
+            time.sleep(args.refresh_every * 60)
+            fresh = get_mf_scraper(args.limit, args.db, args.processes,
+                                   db=mf_scraper.db, adjusted=args.adjusted)
+            try:
+                fresh.run_all()
+                fresh = load_mf_scraper_with_df(fresh)
+            except Exception as e:
+                print("{d} - refresh failed: {e}".format(d=datetime.now(), e=e))
+                continue
+            mf_scraper.fund_families = fresh.fund_families
+            mf_scraper.top_families = fresh.top_families
+            mf_scraper.df_all = fresh.df_all
 
-    # 7 day cache expiration.
-    start_date, end_date = get_start_and_end_dates()
-    mf_scraper = MFScraper(db_path, ds, cache_name, 7, start_date, end_date,
-                           limit=limit)
-    return mf_scraper
+    thread = threading.Thread(target=refresh, daemon=True)
+    thread.start()
+    return thread
 
-def load_mf_scraper_with_df(mf_scraper):
 
-    mf_scraper.run_all()
-    mf_scraper.top_fund_families = mf_scraper.top_fund_families()
+def run_serve(args):
+    from dashboard import get_app, load_mf_scraper_with_df
 
-    out = []
-    for f in mf_scraper.top_fund_families:
-        ff = mf_scraper.fund_families[f["fund_family"]]
-        df = ff["prices"]
-        df = mf_scraper.merge_symbols_to_daily(df, dataframe=True)
-        df["fund_family"] = f["fund_family"]
-        out.append(df)
+    inital_header = "Top Fund Families by Growth Rate"
 
-    mf_scraper.df_all = mf_scraper.combine_dataframes(out)
-    return mf_scraper
+    mf_scraper = get_mf_scraper(args.limit, args.db, args.processes,
+                                adjusted=args.adjusted)
+    # Charts and tables read the materialized tables, raw prices are only
+    # read per family when one is selected.
+    if not mf_scraper.load_universe():
+        # Nothing discovered yet, scrape everything once.
+        mf_scraper.run_all()
+
+    mf_scraper = load_mf_scraper_with_df(mf_scraper)
 
-def time_series_graphes(df):
-    graphs = [
-        go.Scatter(
-            x=df[df.fund_family == i]["date"],
-            y=df[df.fund_family == i]["close"],
-            text=i,
-            name=i,
-            mode="lines",
-        ) for i in df.fund_family.unique()
-    ]
-    return graphs
-
-def time_series_layout():
-	return go.Layout(
-		xaxis={"type": "date", "title": "Date"},
-
-		yaxis=go.layout.YAxis(
-            title="Closing Price",
-            automargin=True,
-        ),
-		legend={'x': 0, 'y': 1},
-		hovermode='closest',
-        autosize=True,
-        height=900,
-	)
-
-def get_datatable(df):
-	df = df[["symbol", "close"]]
-	return df.groupby(df.symbol).mean().reset_index()
-
-def get_app_layout(header, mf_scraper):
-    ts_graphs = time_series_graphes(mf_scraper.df_all)
-    ts_layout = time_series_layout()
-    fund_families = [
-        {"label": i, "value": i} for i in mf_scraper.fund_families.keys()
-    ]
-
-    l = html.Div([
-            html.H4(header),
-            html.Label("Specific Fund Family"),
-            dcc.Dropdown(
-                id="ff-id",
-                options=fund_families,
-                #multi=True
-            ),
-            dcc.Graph(
-                id="graph-mf",
-                figure={
-                    "data": ts_graphs,
-                    "layout": ts_layout
-                },
-                style={"height": "100%"},
-            ),
-        ],
-        className="container",
-        style={"height": "100%"},
-    )
-    #dt.DataTable(
-    #    rows=df_datatable.to_dict("records"),
-    #    columns=df_datatable.columns,
-    #    row_selectable=True,
-    #    filterable=True,
-    #    sortable=True,
-    #    selected_row_indices=[],
-
-    #    id="datatable-mf",
-    #),
-    return l
+    print("done grabbing dataframes.")
+    print("loading dash app")
 
+    app = get_app(inital_header, mf_scraper)
+    # With --debug the reloader runs this in a watcher and a serving
+    # process, only the serving one (WERKZEUG_RUN_MAIN) refreshes.
+    serving = not args.debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true"
+    if args.refresh_every and serving:
+        start_refresher(mf_scraper, args)
+    app.run_server(debug=args.debug)
 
-def logit(dataframes):
-    l = len(dataframes)
-    if l % 10 == 0:
-        symbol = dataframes[-1].ix[0].symbol
-        msg="{d} {s}: grabbed stats on {l} symbols".format(d=datetime.now(), s=symbol, l=l)
-        print(msg)
 
-if __name__ == "__main__":
-    inital_header = "Top Fund Families by Growth Rate"
+def run_export(args):
+    from export import connect, export
+
+    chunks = export(connect(args.db), args.dataset, args.format,
+                    families=args.family, symbols=args.symbol,
+                    start=args.start, end=args.end)
 
+    if args.output:
+        with open(args.output, "wb") as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+    else:
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        sys.stdout.flush()
+
+
+COMMANDS = {
+    "export": run_export,
+    "list": run_list,
+    "refresh": run_refresh,
+    "serve": run_serve,
+}
+
+
+if __name__ == "__main__":
     list_desc = "List all fund families and exit."
     db_desc = "Path for sqlite db storing pricing info."
+    processes_desc = "Worker processes for ranking families, 1 disables."
+    rediscover_desc = "Download family and fund pages again on refresh."
+    refresh_desc = "Refresh prices in the background every N minutes."
+    adjusted_desc = "Use dividend/split adjusted closes (fetches events)."
 
     parser = argparse.ArgumentParser()
+    parser.add_argument("command", nargs="?", default="serve",
+                        choices=sorted(COMMANDS))
     parser.add_argument("--limit", nargs="+")
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--list", help=list_desc, action="store_true")
     parser.add_argument("--db", help=db_desc, default="data/mf.sqlite")
+    parser.add_argument("--processes", help=processes_desc, type=int)
+    parser.add_argument("--rediscover", help=rediscover_desc,
+                        action="store_true")
+    parser.add_argument("--refresh-every", help=refresh_desc, type=int)
+    parser.add_argument("--adjusted", help=adjusted_desc, action="store_true")
+
+    export_args = parser.add_argument_group("export")
+    export_args.add_argument("--dataset", default="rankings",
+                             choices=["daily", "rankings", "symbols"])
+    export_args.add_argument("--format", default="csv",
+                             choices=["csv", "ndjson", "parquet"])
+    export_args.add_argument("--family", nargs="+")
+    export_args.add_argument("--symbol", nargs="+")
+    export_args.add_argument("--start", help="YYYY-MM-DD")
+    export_args.add_argument("--end", help="YYYY-MM-DD")
+    export_args.add_argument("--output", help="File to write, default stdout.")
     args = parser.parse_args()
 
-    mf_scraper = get_mf_scraper(args.limit, args.db)
     if args.list:
-        print("All Fund Families Available:")
-        for ff in mf_scraper.list_all_fund_families():
-            print(ff)
-        sys.exit(0)
+        args.command = "list"
 
-    mf_scraper = load_mf_scraper_with_df(mf_scraper)
-
-    print("done grabbing dataframes.")
-    print("loading dash app")
-
-    app = get_app(inital_header, mf_scraper)
-    app.run_server(debug=args.debug)
+    COMMANDS[args.command](args)
+    sys.exit(0)
@@ -0,0 +1,220 @@
+# coding: utf8
+from collections import OrderedDict
+import threading
+
+import numpy as np
+
+# Symbols per side of each block multiplied at a time.
+BLOCK_SIZE = 512
+
+# Pairs with fewer common daily returns than this are left as NaN.
+MIN_PERIODS = 20
+
+# Bytes of (corr, overlap) results kept around, oldest dropped first.
+CACHE_BYTES = 256 * 1024 * 1024
+
+# Symbols drawn per side of the heatmap, larger matrices are reduced.
+MAX_HEATMAP_SYMBOLS = 150
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+
+
+def _symbol_chunks(symbols, size=500):
+    for i in range(0, len(symbols), size):
+        yield symbols[i:i + size]
+
+
+def returns_matrix(dbh, symbols, start=None, end=None, dtype=np.float64):
+    """Aligned daily returns, one column per symbol, dates as the index."""
+    import pandas as pd
+
+    frames = []
+    for chunk in _symbol_chunks(list(symbols)):
+        query = (
+            "SELECT symbol, date, close FROM mutual_fund_prices "
+            "WHERE symbol IN ({})"
+        ).format(",".join(["?"] * len(chunk)))
+        params = list(chunk)
+        if start:
+            query += " AND date >= ?"
+            params.append(str(start))
+        if end:
+            query += " AND date <= ?"
+            params.append(str(end) + " 23:59:59")
+        frames.append(pd.read_sql_query(query, dbh, params=params))
+
+    df = pd.concat(frames) if frames else pd.DataFrame(
+        columns=["symbol", "date", "close"])
+    close = df.pivot_table(index="date", columns="symbol", values="close")
+    close = close.reindex(columns=[s for s in symbols if s in close.columns])
+    return close.pct_change(fill_method=None).iloc[1:].astype(dtype)
+
+
+def correlation_matrix(returns, block_size=BLOCK_SIZE,
+                       min_periods=MIN_PERIODS):
+    """Pairwise correlations and overlaps of the columns of `returns`.
+
+    Every pair is measured over the days both funds have, like
+    `DataFrame.corr(min_periods=...)`. With missing days as zeros and M
+    the mask of present days, the per-pair sums come from block products:
+    n = M_i'M_j, Sx = X_i'M_j, Sy = M_i'X_j, Sxx = (X_i^2)'M_j,
+    Syy = M_i'(X_j^2) and Sxy = X_i'X_j. The overlap matrix is n.
+
+    Pairs with fewer than `min_periods` common days, or with no variance
+    over them (constant NAV funds), are NaN.
+    """
+    x = np.asarray(returns)
+    dtype = x.dtype if x.dtype in (np.float32, np.float64) else np.float64
+    x = x.astype(dtype, copy=True)
+
+    mask = ~np.isnan(x)
+    # Pearson doesn't change under a shift, centering only keeps the
+    # sums small.
+    with np.errstate(invalid="ignore"):
+        x -= np.where(mask.any(axis=0), np.nanmean(x, axis=0), 0)
+    x[~mask] = 0
+    x2 = x * x
+    m = mask.astype(dtype)
+
+    n = x.shape[1]
+    corr = np.empty((n, n), dtype=dtype)
+    # Overlaps are day counts, a small int keeps them a fraction of corr.
+    small = x.shape[0] <= np.iinfo(np.uint16).max
+    overlap_dtype = np.uint16 if small else np.int32
+    overlap = np.empty((n, n), dtype=overlap_dtype)
+    for i in range(0, n, block_size):
+        xi = x[:, i:i + block_size]
+        x2i = x2[:, i:i + block_size]
+        mi = m[:, i:i + block_size]
+        for j in range(i, n, block_size):
+            xj = x[:, j:j + block_size]
+            x2j = x2[:, j:j + block_size]
+            mj = m[:, j:j + block_size]
+
+            cnt = mi.T @ mj
+            sx = xi.T @ mj
+            sy = mi.T @ xj
+            sxx = x2i.T @ mj
+            syy = mi.T @ x2j
+            sxy = xi.T @ xj
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                cov = sxy - sx * sy / cnt
+                var_x = sxx - sx * sx / cnt
+                var_y = syy - sy * sy / cnt
+                block = cov / np.sqrt(var_x * var_y)
+
+            eps = np.finfo(dtype).eps
+            flat = (var_x <= eps * sxx) | (var_y <= eps * syy)
+            block[(cnt < min_periods) | flat] = np.nan
+
+            corr[i:i + block_size, j:j + block_size] = block
+            corr[j:j + block_size, i:i + block_size] = block.T
+            overlap[i:i + block_size, j:j + block_size] = cnt
+            overlap[j:j + block_size, i:i + block_size] = cnt.T
+
+    return corr, overlap
+
+
+def _nbytes(result):
+    return sum(int(df.values.nbytes) for df in result)
+
+
+def top_symbols(corr, overlap, k=MAX_HEATMAP_SYMBOLS):
+    """The `k` symbols with the most days of returns, in their order."""
+    if len(corr) <= k:
+        return corr, overlap
+    days = np.diag(overlap.values)
+    keep = np.sort(np.argsort(-days, kind="stable")[:k])
+    return corr.iloc[keep, keep], overlap.iloc[keep, keep]
+
+
+def group_means(corr, overlap, groups):
+    """Mean correlation and overlap between groups of symbols.
+
+    `groups` maps symbol -> group (fund family). Pairs of a symbol with
+    itself are left out, NaN pairs don't count.
+    """
+    import pandas as pd
+
+    labels = list(dict.fromkeys(groups[s] for s in corr.columns))
+    members = {
+        g: np.flatnonzero([groups[s] == g for s in corr.columns])
+        for g in labels
+    }
+    c = corr.values
+    o = overlap.values
+    n = len(labels)
+    means = np.full((n, n), np.nan)
+    days = np.zeros((n, n), dtype=np.int64)
+    for i, a in enumerate(labels):
+        for j, b in enumerate(labels):
+            block = c[np.ix_(members[a], members[b])].astype(np.float64)
+            block_days = o[np.ix_(members[a], members[b])]
+            valid = np.isfinite(block)
+            if a == b:
+                np.fill_diagonal(valid, False)
+            if valid.any():
+                means[i, j] = block[valid].mean()
+                days[i, j] = int(block_days[valid].mean())
+    return (
+        pd.DataFrame(means, index=labels, columns=labels),
+        pd.DataFrame(days, index=labels, columns=labels),
+    )
+
+
+def _data_version(dbh, symbols):
+    """Changes whenever prices for `symbols` are added."""
+    version = []
+    for chunk in _symbol_chunks(list(symbols)):
+        query = (
+            "SELECT MAX(date), COUNT(*) FROM mutual_fund_prices "
+            "WHERE symbol IN ({})"
+        ).format(",".join(["?"] * len(chunk)))
+        curr = dbh.cursor()
+        curr.execute(query, chunk)
+        version.append(curr.fetchone())
+        curr.close()
+    return tuple(version)
+
+
+def symbol_correlations(dbh, symbols, start=None, end=None, float32=False):
+    """(corr, overlap) DataFrames for `symbols`, cached per price version.
+
+    The cache is bounded by `CACHE_BYTES`, a result bigger than that on
+    its own isn't kept.
+    """
+    import pandas as pd
+
+    symbols = tuple(sorted(set(symbols)))
+    dtype = np.float32 if float32 else np.float64
+    key = (symbols, str(start), str(end), dtype,
+           _data_version(dbh, symbols))
+
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    returns = returns_matrix(dbh, symbols, start, end, dtype=dtype)
+    corr, overlap = correlation_matrix(returns)
+    labels = list(returns.columns)
+    result = (
+        pd.DataFrame(corr, index=labels, columns=labels),
+        pd.DataFrame(overlap, index=labels, columns=labels),
+    )
+
+    global _cache_bytes
+    size = _nbytes(result)
+    if size > CACHE_BYTES:
+        return result
+    with _cache_lock:
+        if key not in _cache:
+            _cache[key] = result
+            _cache_bytes += size
+        while _cache_bytes > CACHE_BYTES:
+            _, old = _cache.popitem(last=False)
+            _cache_bytes -= _nbytes(old)
+    return result
@@ -0,0 +1,319 @@
+# coding: utf8
+import dash
+import dash_core_components as dcc
+import dash_html_components as html
+import dash_table_experiments as dt
+
+from dash.dependencies import Input, Output
+
+import plotly.graph_objs as go
+
+from correlation import (
+    MAX_HEATMAP_SYMBOLS,
+    group_means,
+    symbol_correlations,
+    top_symbols,
+)
+from export import register_routes
+from query import QueryEngine, TABLE_COLUMNS
+
+TOP_FAMILIES = "__top__"
+TABLE_PAGE_SIZE = 25
+
+
+def get_app(header, mf_scraper):
+    app = dash.Dash(sharing=True, csrf_protect=False)
+
+    # Built on every page load, so whatever the refresher swapped in
+    # (families, ranking, series) shows up without a restart.
+    app.layout = lambda: get_app_layout(header, mf_scraper)
+
+    register_routes(app.server, mf_scraper.db)
+
+    engine = QueryEngine(mf_scraper.db, adjusted=mf_scraper.adjusted)
+
+    @app.callback(
+        Output("graph-mf", "figure"),
+        [Input("ff-id", "value"),
+         Input("resolution-id", "value"),
+         Input("date-range", "start_date"),
+         Input("date-range", "end_date")])
+    def update_figure(selected_families, resolution, start_date, end_date):
+        if isinstance(selected_families, str):
+            selected_families = [selected_families]
+
+        if selected_families and len(selected_families) == 1:
+            return winners_losers_figure(mf_scraper, selected_families[0])
+
+        families = selected_families or [
+            f["fund_family"] for f in mf_scraper.top_families
+        ]
+        df = engine.series(families=families, start=start_date, end=end_date,
+                           resolution=resolution or "D")
+        df = df.rename(columns={"key": "fund_family"})
+        return {
+            "data": time_series_graphes(df),
+            "layout": time_series_layout(),
+        }
+
+    @app.callback(
+        Output("datatable-mf", "rows"),
+        [Input("table-page", "value"),
+         Input("datatable-mf", "sortColumn"),
+         Input("datatable-mf", "sortDirection"),
+         Input("datatable-mf", "filters"),
+         Input("ff-id", "value")])
+    def update_table(page, sort_column, sort_direction, filters, families):
+        return engine.table_page(
+            page=(page or 1) - 1,
+            page_size=TABLE_PAGE_SIZE,
+            sort_column=sort_column,
+            sort_direction=sort_direction,
+            filters=datatable_filters(filters),
+            families=families or None,
+        )
+
+    @app.callback(
+        Output("table-page-count", "children"),
+        [Input("datatable-mf", "filters"),
+         Input("ff-id", "value")])
+    def update_table_count(filters, families):
+        total = engine.table_count(filters=datatable_filters(filters),
+                                   families=families or None)
+        pages = max((total + TABLE_PAGE_SIZE - 1) // TABLE_PAGE_SIZE, 1)
+        return "of {p} ({t} funds)".format(p=pages, t=total)
+
+    @app.callback(
+        Output("graph-corr", "figure"),
+        [Input("corr-id", "value")])
+    def update_correlations(selected):
+        if not selected:
+            return {"data": [], "layout": correlation_layout()}
+
+        if selected == TOP_FAMILIES:
+            families = [f["fund_family"] for f in mf_scraper.top_families]
+        else:
+            families = [selected]
+
+        groups = dict()
+        for f in families:
+            for s in mf_scraper.fund_families[f].get("symbols") or []:
+                groups.setdefault(s["symbol"], f)
+        symbols = list(groups)
+        if not symbols:
+            return {"data": [], "layout": correlation_layout()}
+
+        corr, overlap = symbol_correlations(mf_scraper.db.reader(), symbols,
+                                            float32=len(symbols) > 1000)
+        # Keep what goes to the browser small: families become their mean
+        # block, a single large family its best covered symbols.
+        if len(corr) > MAX_HEATMAP_SYMBOLS:
+            if len(families) > 1:
+                corr, overlap = group_means(corr, overlap, groups)
+            else:
+                corr, overlap = top_symbols(corr, overlap)
+        return {
+            "data": [
+                go.Heatmap(
+                    z=corr.values,
+                    x=list(corr.columns),
+                    y=list(corr.index),
+                    text=overlap.values,
+                    zmin=-1,
+                    zmax=1,
+                    colorscale="RdBu",
+                    reversescale=True,
+                )
+            ],
+            "layout": correlation_layout(),
+        }
+
+    return app
+
+def winners_losers_figure(mf_scraper, selected_family):
+
+    color_green = "#088c31"
+    color_red = "#FC6955"
+
+    # Only the selected family's prices are read, serve keeps none.
+    selected_df = mf_scraper.family_prices(selected_family)
+    if selected_df is None:
+        return {"data": [], "layout": time_series_layout()}
+
+    selected_df = mf_scraper.winners_losers(selected_df)
+
+    sorted_symbols = []
+    for s in selected_df.symbol.unique():
+       gr = selected_df[selected_df.symbol == s]["growth_rate"].values[0]
+       sorted_symbols.append((gr, s))
+
+    sorted_symbols.sort(key=lambda x: x[0], reverse=True)
+
+    funds = []
+    for gr, i in sorted_symbols:
+        df_symbol = selected_df[selected_df.symbol == i]
+
+        winner = selected_df[selected_df.symbol == i]["winner"].values[0]
+        if winner[0] == "w":
+            color = color_green
+        else:
+            color = color_red
+
+        funds.append(
+            go.Scatter(
+                x=df_symbol["date"],
+                y=df_symbol["close"],
+                text=df_symbol["name_x"] + "<br>" + df_symbol["winner"],
+                mode="lines",
+                name=i,
+                marker=dict(
+                    color=color
+                ),
+            )
+        )
+    return {
+        "data": funds,
+        "layout": time_series_layout(),
+    }
+
+def datatable_filters(filters):
+    """DataTable's {column: {"filterTerm": term}} -> {column: term}."""
+    out = dict()
+    for column, f in (filters or {}).items():
+        if isinstance(f, dict):
+            f = f.get("filterTerm")
+        if f:
+            out[column] = f
+    return out
+
+def load_mf_scraper_with_df(mf_scraper):
+
+    mf_scraper.top_families = mf_scraper.top_fund_families()
+
+    families = [f["fund_family"] for f in mf_scraper.top_families]
+    daily = mf_scraper.family_daily(families)
+
+    out = []
+    for f in families:
+        if f in daily:
+            df = daily[f]
+        else:
+            df = mf_scraper.family_prices(f)
+            if df is None:
+                continue
+            df = mf_scraper.merge_symbols_to_daily(df, dataframe=True)
+        df["fund_family"] = f
+        out.append(df)
+
+    mf_scraper.df_all = mf_scraper.combine_dataframes(out)
+    return mf_scraper
+
+def time_series_graphes(df):
+    graphs = [
+        go.Scatter(
+            x=df[df.fund_family == i]["date"],
+            y=df[df.fund_family == i]["close"],
+            text=i,
+            name=i,
+            mode="lines",
+        ) for i in df.fund_family.unique()
+    ]
+    return graphs
+
+def time_series_layout():
+	return go.Layout(
+		xaxis={"type": "date", "title": "Date"},
+
+		yaxis=go.layout.YAxis(
+            title="Closing Price",
+            automargin=True,
+        ),
+		legend={'x': 0, 'y': 1},
+		hovermode='closest',
+        autosize=True,
+        height=900,
+	)
+
+def correlation_layout():
+    return go.Layout(
+        title="Daily Return Correlations",
+        xaxis={"type": "category"},
+        yaxis={"type": "category", "autorange": "reversed"},
+        autosize=True,
+        height=900,
+    )
+
+def get_datatable(df):
+	df = df[["symbol", "close"]]
+	return df.groupby(df.symbol).mean().reset_index()
+
+def get_app_layout(header, mf_scraper):
+    ts_graphs = time_series_graphes(mf_scraper.df_all)
+    ts_layout = time_series_layout()
+    fund_families = [
+        {"label": i, "value": i} for i in mf_scraper.fund_families.keys()
+    ]
+    correlation_options = (
+        [{"label": "Top Fund Families", "value": TOP_FAMILIES}]
+        + fund_families
+    )
+
+    l = html.Div([
+            html.H4(header),
+            html.Label("Fund Families"),
+            dcc.Dropdown(
+                id="ff-id",
+                options=fund_families,
+                multi=True
+            ),
+            dcc.RadioItems(
+                id="resolution-id",
+                options=[
+                    {"label": "Daily", "value": "D"},
+                    {"label": "Weekly", "value": "W"},
+                    {"label": "Monthly", "value": "M"},
+                    {"label": "Quarterly", "value": "Q"},
+                ],
+                value="D",
+                labelStyle={"display": "inline-block"},
+            ),
+            dcc.DatePickerRange(id="date-range"),
+            dcc.Graph(
+                id="graph-mf",
+                figure={
+                    "data": ts_graphs,
+                    "layout": ts_layout
+                },
+                style={"height": "100%"},
+            ),
+            html.Label("Return Correlations"),
+            dcc.Dropdown(
+                id="corr-id",
+                options=correlation_options,
+            ),
+            dcc.Graph(
+                id="graph-corr",
+                figure={
+                    "data": [],
+                    "layout": correlation_layout(),
+                },
+            ),
+            html.Label("Funds"),
+            dt.DataTable(
+                rows=[{}],
+                columns=TABLE_COLUMNS,
+                row_selectable=False,
+                filterable=True,
+                sortable=True,
+                id="datatable-mf",
+            ),
+            html.Div([
+                html.Label("Page"),
+                dcc.Input(id="table-page", type="number", value=1, min=1),
+                html.Span(id="table-page-count"),
+            ]),
+        ],
+        className="container",
+        style={"height": "100%"},
+    )
+    return l
@@ -1,25 +1,111 @@
 # coding: utf8
 from contextlib import contextmanager
+import datetime
+import os
 import sqlite3
+import threading
+from urllib.parse import quote
 
-jday = lambda x: "julianday(%s)" % x
+
+# Seconds a connection waits on a lock before giving up.
+BUSY_TIMEOUT = 30
 
 class DB:
+    """sqlite access shared between threads.
+
+    Every thread reads through its own read-only connection, all writes go
+    through a single writer connection, one transaction at a time. The db
+    runs in WAL mode so readers are never blocked by the writer.
+    """
 
     def __init__(self, path):
         self.path = path
-        self.dbh = sqlite3.connect(path)
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._depth = 0
+        self._writer = self._connect_writer()
         self.create_tables()
 
+    def _connect_writer(self):
+        dbh = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                              isolation_level=None, check_same_thread=False)
+        dbh.execute("PRAGMA journal_mode=WAL")
+        dbh.execute("PRAGMA synchronous=NORMAL")
+        return dbh
+
+    def _connect_reader(self):
+        if self.path == ":memory:":
+            return self._writer
+        uri = "file:{}?mode=ro".format(quote(os.path.abspath(self.path)))
+        dbh = sqlite3.connect(uri, uri=True, timeout=BUSY_TIMEOUT,
+                              isolation_level=None)
+        dbh.execute("PRAGMA query_only=ON")
+        return dbh
+
+    @property
+    def dbh(self):
+        """The writer connection, only use it inside `transaction`."""
+        return self._writer
+
+    def reader(self):
+        """This thread's read-only connection."""
+        dbh = getattr(self._local, "dbh", None)
+        if dbh is None:
+            dbh = self._local.dbh = self._connect_reader()
+        return dbh
+
+    @contextmanager
+    def transaction(self):
+        """Serialized write transaction, committed on a clean exit.
+
+        Nested use joins the outer transaction.
+        """
+        with self._write_lock:
+            curr = self._writer.cursor()
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield curr
+                finally:
+                    self._depth -= 1
+                    curr.close()
+                return
+
+            self._depth = 1
+            curr.execute("BEGIN IMMEDIATE")
+            try:
+                yield curr
+            except BaseException:
+                curr.execute("ROLLBACK")
+                raise
+            else:
+                curr.execute("COMMIT")
+            finally:
+                self._depth = 0
+                curr.close()
+
+    @contextmanager
+    def cursor_read(self, sql, params=[]):
+        curr = self.reader().cursor()
+        try:
+            curr.execute(sql, params)
+            yield curr
+        finally:
+            curr.close()
+
     @classmethod
     def tables(cls):
         T = "TEXT"
         D = "DATE"
         R = "REAL"
+        I = "INTEGER"
+        TS = "TIMESTAMP"
         CD = "CURRENT_DATE"
+        CT = "CURRENT_TIMESTAMP"
         return {
             "mutual_funds": {
                 "pk": ("symbol", "fund_family"),
+                "indexes": [("fund_family",),],
                 "columns": [
                     ("symbol", T),
                     ("fund_family", T),
@@ -46,6 +132,94 @@ class DB:
                     ("close", R),
                     ("volume", R),
                 ]
+            },
+            "price_events": {
+                "pk": ("symbol", "date", "action"),
+                "fk": [("symbol", "mutual_funds", "symbol"),],
+                "columns": [
+                    ("symbol", T),
+                    ("date", D),
+                    ("action", T),
+                    ("value", R),
+                    ("factor", R),
+                ]
+            },
+            "event_lookups": {
+                "pk": ("symbol", "date"),
+                "fk": [("symbol", "mutual_funds", "symbol"),],
+                "columns": [
+                    ("symbol", T),
+                    ("date", D),
+                ]
+            },
+            "adjusted_prices": {
+                "pk": ("symbol", "date"),
+                "fk": [("symbol", "mutual_funds", "symbol"),],
+                "columns": [
+                    ("symbol", T),
+                    ("date", D),
+                    ("adj_close", R),
+                ]
+            },
+            "family_daily_averages": {
+                "pk": ("fund_family", "date"),
+                "columns": [
+                    ("fund_family", T),
+                    ("date", D),
+                    ("close_sum", R),
+                    ("close_count", I),
+                    ("close_mean", R),
+                    ("adj_close_sum", R),
+                    ("adj_close_mean", R),
+                ]
+            },
+            "symbol_summaries": {
+                "pk": ("symbol",),
+                "columns": [
+                    ("symbol", T),
+                    ("first_date", D),
+                    ("first_close", R),
+                    ("last_date", D),
+                    ("last_close", R),
+                ]
+            },
+            "universe_versions": {
+                "pk": ("version",),
+                "columns": [
+                    ("version", I),
+                    ("created", TS, CT),
+                ]
+            },
+            "universe_families": {
+                "pk": ("fund_family", "version"),
+                "fk": [("version", "universe_versions", "version"),],
+                "columns": [
+                    ("fund_family", T),
+                    ("version", I),
+                    ("href", T),
+                    ("fund_page", T),
+                    ("family_hash", T),
+                    ("fund_page_hash", T),
+                ]
+            },
+            "universe_symbols": {
+                "pk": ("symbol", "fund_family", "version"),
+                "fk": [("version", "universe_versions", "version"),],
+                "columns": [
+                    ("symbol", T),
+                    ("fund_family", T),
+                    ("version", I),
+                    ("name", T),
+                ]
+            },
+            "inactive_funds": {
+                "pk": ("symbol", "fund_family"),
+                "fk": [("symbol", "mutual_funds", "symbol"),],
+                "columns": [
+                    ("symbol", T),
+                    ("fund_family", T),
+                    ("date", D, CD),
+                ]
             }
         }
 
@@ -99,52 +273,503 @@ class DB:
 
         return statement.format(**formatter)
 
-    @contextmanager
-    def cursor_execute(self, sql, params=[]):
-        curr = self.dbh.cursor()
-        curr.execute(sql, params)
-        self.dbh.commit()
-        yield curr
-        curr.close()
+    @classmethod
+    def index_statements(cls, table, definition):
+        statements = dict()
+        for columns in definition.get("indexes", []):
+            name = "idx_{t}_{c}".format(t=table, c="_".join(columns))
+            statements[name] = "CREATE INDEX IF NOT EXISTS {n} ON {t} ({c});".format(
+                n=name, t=table, c=",".join(columns))
+        return statements
+
+    def existing_tables(self):
+        query = "SELECT name FROM sqlite_master WHERE type IN ('table', 'index')"
+        with self.cursor_read(query) as curr:
+            return set(r[0] for r in curr.fetchall())
+
+    def existing_columns(self, table):
+        with self.cursor_read("PRAGMA table_info({})".format(table)) as curr:
+            return set(r[1] for r in curr.fetchall())
 
     def create_tables(self):
         tables = DB.tables()
+        existing = self.existing_tables()
+
+        statements = []
+        rebuild = set()
         for t in tables:
-            statement = DB.create_statement(t, tables[t])
-            #for statement in statements:
-            with self.cursor_execute(statement) as curr:
-                _ = curr.rowcount
+            if t not in existing:
+                statements.append(DB.create_statement(t, tables[t]))
+                rebuild.add(t)
+            else:
+                # Columns added to a table after it was first created.
+                columns = self.existing_columns(t)
+                for c in tables[t]["columns"]:
+                    if c[0] not in columns:
+                        statements.append(
+                            "ALTER TABLE {t} ADD COLUMN {c} {d}".format(
+                                t=t, c=c[0], d=c[1]))
+                        rebuild.add(t)
+            for name, statement in DB.index_statements(t, tables[t]).items():
+                if name not in existing:
+                    statements.append(statement)
+        if not statements:
+            return
 
-    def log_symbol_lookup(self, symbol):
-        query = "INSERT INTO symbol_lookups (symbol) VALUES (?)"
+        with self.transaction() as curr:
+            for statement in statements:
+                curr.execute(statement)
 
-        with self.cursor_execute(query, params=[symbol]) as curr:
-            _ = curr.rowcount
+            if "family_daily_averages" in rebuild:
+                self.rebuild_family_daily_averages()
+            if "symbol_summaries" in rebuild:
+                self.rebuild_symbol_summaries()
 
-    def last_symbol_lookup(self, symbol):
-        current_date = jday("CURRENT_DATE")
-        latest_lookup = jday("MAX(date)")
-        max_date = "MAX(date)"
+    def rebuild_family_daily_averages(self):
+        """Recompute every family's daily close aggregates from scratch.
 
+        Closes not adjusted yet count as their own adjusted close.
+        """
         query = (
-            "SELECT "
-                "{c} - {l} as diff , "
-                "{m} as max_date "
-            "FROM "
-            "   symbol_lookups "
-            "WHERE "
-            "   symbol = ?"
-        ).format(c=current_date, l=latest_lookup, m=max_date)
-        with self.cursor_execute(query, params=[symbol]) as curr:
-            return curr.fetchone()
+            "INSERT INTO family_daily_averages "
+            "(fund_family, date, close_sum, close_count, close_mean, "
+            "adj_close_sum, adj_close_mean) "
+            "SELECT f.fund_family, p.date, SUM(p.close), COUNT(p.close), "
+            "AVG(p.close), SUM(COALESCE(a.adj_close, p.close)), "
+            "AVG(COALESCE(a.adj_close, p.close)) "
+            "FROM mutual_fund_prices p "
+            "JOIN mutual_funds f ON f.symbol = p.symbol "
+            "LEFT JOIN adjusted_prices a "
+            "ON a.symbol = p.symbol AND a.date = p.date "
+            "WHERE NOT EXISTS ("
+            "    SELECT 1 FROM inactive_funds i "
+            "    WHERE i.symbol = p.symbol AND i.fund_family = f.fund_family"
+            ") "
+            "GROUP BY f.fund_family, p.date"
+        )
+        with self.transaction() as curr:
+            curr.execute("DELETE FROM family_daily_averages")
+            curr.execute(query)
+
+    def _shift_family_daily_averages(self, curr, fund_family, symbol, sign):
+        """Add (sign=1) or subtract (sign=-1) all of `symbol`'s closes
+        to `fund_family`'s aggregates, if it is one of its funds."""
+        curr.execute(
+            "SELECT 1 FROM mutual_funds WHERE symbol = ? AND fund_family = ?",
+            [symbol, fund_family])
+        if curr.fetchone() is None:
+            return
+
+        dates = (
+            "SELECT date FROM mutual_fund_prices "
+            "WHERE symbol = ? AND close IS NOT NULL"
+        )
+        insert = (
+            "INSERT OR IGNORE INTO family_daily_averages "
+            "(fund_family, date, close_sum, close_count, adj_close_sum) "
+            "SELECT ?, date, 0, 0, 0 FROM ({})"
+        ).format(dates)
+        close = (
+            "SELECT {c} FROM mutual_fund_prices p "
+            "LEFT JOIN adjusted_prices a "
+            "ON a.symbol = p.symbol AND a.date = p.date "
+            "WHERE p.symbol = ? AND p.date = family_daily_averages.date"
+        )
+        update = (
+            "UPDATE family_daily_averages SET "
+            "close_sum = close_sum + ? * ({close}), "
+            "adj_close_sum = adj_close_sum + ? * ({adj_close}), "
+            "close_count = close_count + ? "
+            "WHERE fund_family = ? AND date IN ({dates})"
+        ).format(close=close.format(c="p.close"),
+                 adj_close=close.format(c="COALESCE(a.adj_close, p.close)"),
+                 dates=dates)
+        mean = (
+            "UPDATE family_daily_averages SET "
+            "close_mean = close_sum / close_count, "
+            "adj_close_mean = adj_close_sum / close_count "
+            "WHERE fund_family = ? AND close_count > 0 AND date IN ({})"
+        ).format(dates)
+        curr.execute(insert, [fund_family, symbol])
+        curr.execute(update, [sign, symbol, sign, symbol, sign, fund_family,
+                              symbol])
+        curr.execute(mean, [fund_family, symbol])
+        curr.execute(
+            "DELETE FROM family_daily_averages "
+            "WHERE fund_family = ? AND close_count = 0", [fund_family])
+
+    def update_family_daily_averages(self, fund_family, df):
+        """Fold newly inserted prices (`date`, `close`) into the aggregates.
+
+        They aren't adjusted yet, so their close is also added to the
+        adjusted sums until `replace_adjusted` swaps it.
+        """
+        close = df["close"].astype(float)
+        daily = close.groupby(df["date"]).agg(["sum", "count"])
+        daily = daily[daily["count"] > 0]
+        if not len(daily):
+            return
+        rows = [
+            (fund_family, d, float(r[0]), int(r[1]))
+            for d, r in zip(daily.index, daily.values)
+        ]
+
+        insert = (
+            "INSERT OR IGNORE INTO family_daily_averages "
+            "(fund_family, date, close_sum, close_count, adj_close_sum) "
+            "VALUES (?,?,0,0,0)"
+        )
+        update = (
+            "UPDATE family_daily_averages SET "
+            "close_sum = close_sum + ?, "
+            "close_count = close_count + ?, "
+            "close_mean = (close_sum + ?) / (close_count + ?), "
+            "adj_close_sum = adj_close_sum + ?, "
+            "adj_close_mean = (adj_close_sum + ?) / (close_count + ?) "
+            "WHERE fund_family = ? AND date = ?"
+        )
+        with self.transaction() as curr:
+            curr.executemany(insert, [r[:2] for r in rows])
+            curr.executemany(
+                update,
+                [(r[2], r[3], r[2], r[3], r[2], r[2], r[3], r[0], r[1])
+                 for r in rows]
+            )
+
+    def rebuild_symbol_summaries(self):
+        """Recompute every symbol's first and last close from scratch."""
+        query = (
+            "INSERT INTO symbol_summaries "
+            "(symbol, first_date, first_close, last_date, last_close) "
+            "SELECT b.symbol, b.first_date, s.close, b.last_date, l.close "
+            "FROM ("
+            "    SELECT symbol, MIN(date) AS first_date, MAX(date) AS last_date "
+            "    FROM mutual_fund_prices GROUP BY symbol"
+            ") b "
+            "JOIN mutual_fund_prices s "
+            "    ON s.symbol = b.symbol AND s.date = b.first_date "
+            "JOIN mutual_fund_prices l "
+            "    ON l.symbol = b.symbol AND l.date = b.last_date"
+        )
+        with self.transaction() as curr:
+            curr.execute("DELETE FROM symbol_summaries")
+            curr.execute(query)
+
+    def update_symbol_summary(self, symbol, df):
+        """Move `symbol`'s first/last close out to newly inserted prices."""
+        if not len(df):
+            return
+        df = df.sort_values("date")
+        first = df.iloc[0]
+        last = df.iloc[-1]
+
+        insert = (
+            "INSERT OR IGNORE INTO symbol_summaries "
+            "(symbol, first_date, first_close, last_date, last_close) "
+            "VALUES (?,?,?,?,?)"
+        )
+        update_first = (
+            "UPDATE symbol_summaries SET first_date = ?, first_close = ? "
+            "WHERE symbol = ? AND first_date > ?"
+        )
+        update_last = (
+            "UPDATE symbol_summaries SET last_date = ?, last_close = ? "
+            "WHERE symbol = ? AND last_date < ?"
+        )
+        with self.transaction() as curr:
+            curr.execute(insert, [symbol, first["date"], first["close"],
+                                  last["date"], last["close"]])
+            curr.execute(update_first, [first["date"], first["close"],
+                                        symbol, first["date"]])
+            curr.execute(update_last, [last["date"], last["close"],
+                                       symbol, last["date"]])
+
+    def log_symbol_lookup(self, symbol, date):
+        """Record that `symbol` was requested once `date`'s NAV was out."""
+        query = (
+            "INSERT OR IGNORE INTO symbol_lookups (symbol, date) VALUES (?,?)"
+        )
+        with self.transaction() as curr:
+            curr.execute(query, [symbol, str(date)])
+
+    def _last_dates(self, table, symbols):
+        """symbol -> latest `date` in `table`, for `symbols`."""
+        symbols = list(symbols)
+        parse = lambda x: datetime.datetime.strptime(x[:10], "%Y-%m-%d").date()
+        out = dict()
+        # Stay under sqlite's limit on bound parameters.
+        for i in range(0, len(symbols), 500):
+            chunk = symbols[i:i + 500]
+            query = (
+                "SELECT symbol, MAX(date) FROM {t} "
+                "WHERE symbol IN ({p}) GROUP BY symbol"
+            ).format(t=table, p=",".join(["?"] * len(chunk)))
+            with self.cursor_read(query, params=chunk) as curr:
+                out.update(
+                    (r[0], parse(r[1])) for r in curr.fetchall() if r[1])
+        return out
+
+    def last_price_dates(self, symbols):
+        """symbol -> date of the latest stored price, for `symbols`."""
+        return self._last_dates("mutual_fund_prices", symbols)
+
+    def last_symbol_lookups(self, symbols):
+        """symbol -> NAV date of the latest price request, for `symbols`."""
+        return self._last_dates("symbol_lookups", symbols)
+
+    def last_event_lookups(self, symbols):
+        """symbol -> NAV date up to which events have been fetched."""
+        return self._last_dates("event_lookups", symbols)
+
+    def log_event_lookups(self, symbols, date):
+        query = "INSERT OR IGNORE INTO event_lookups (symbol, date) VALUES (?,?)"
+        with self.transaction() as curr:
+            curr.executemany(query, [[s, str(date)] for s in symbols])
+
+    def insert_events(self, events):
+        """Store new events, returning the symbols that had any."""
+        query = (
+            "INSERT OR IGNORE INTO price_events "
+            "(symbol, date, action, value, factor) VALUES (?,?,?,?,?)"
+        )
+        dates = events["date"].dt.strftime("%Y-%m-%d %H:%M:%S")
+        changed = set()
+        with self.transaction() as curr:
+            for row, date in zip(events.itertuples(index=False), dates):
+                curr.execute(query, [row.symbol, date, row.action,
+                                     float(row.value), float(row.factor)])
+                if curr.rowcount:
+                    changed.add(row.symbol)
+        return changed
+
+    def reset_event_factors(self, symbols, action):
+        """Set the factor of `symbols`' `action` events back to 1,
+        returning the symbols that had any other factor."""
+        placeholders = ",".join(["?"] * len(symbols))
+        where = "action = ? AND factor != 1 AND symbol IN ({})".format(
+            placeholders)
+        params = [action] + list(symbols)
+        with self.transaction() as curr:
+            curr.execute(
+                "SELECT DISTINCT symbol FROM price_events WHERE " + where,
+                params)
+            changed = set(r[0] for r in curr.fetchall())
+            if changed:
+                curr.execute(
+                    "UPDATE price_events SET factor = 1 WHERE " + where,
+                    params)
+        return changed
+
+    def prices_frame(self, symbols, unadjusted_only=False):
+        """(symbol, date, close) of `symbols`, optionally only the rows
+        not in adjusted_prices yet."""
+        import pandas as pd
+
+        placeholders = ",".join(["?"] * len(symbols))
+        query = (
+            "SELECT p.symbol, p.date, p.close FROM mutual_fund_prices p "
+            "{join} WHERE p.symbol IN ({ph}) {unadjusted}"
+        ).format(
+            ph=placeholders,
+            join=(
+                "LEFT JOIN adjusted_prices a "
+                "ON a.symbol = p.symbol AND a.date = p.date"
+            ) if unadjusted_only else "",
+            unadjusted="AND a.symbol IS NULL" if unadjusted_only else "",
+        )
+        return pd.read_sql_query(query, self.reader(), params=list(symbols))
+
+    def events_frame(self, symbols):
+        import pandas as pd
+
+        placeholders = ",".join(["?"] * len(symbols))
+        query = (
+            "SELECT symbol, date, action, value, factor FROM price_events "
+            "WHERE symbol IN ({})"
+        ).format(placeholders)
+        return pd.read_sql_query(query, self.reader(), params=list(symbols))
+
+    def adjusted_frame(self, symbols):
+        """(symbol, date, adj_close) of `symbols`."""
+        import pandas as pd
+
+        placeholders = ",".join(["?"] * len(symbols))
+        query = (
+            "SELECT symbol, date, adj_close FROM adjusted_prices "
+            "WHERE symbol IN ({})"
+        ).format(placeholders)
+        return pd.read_sql_query(query, self.reader(), params=list(symbols))
+
+    def _adjusted_average_deltas(self, curr, df):
+        """(delta, fund_family, date) rows moving the families' adjusted
+        sums from the stored adjusted closes of `df`'s rows to its own."""
+        import pandas as pd
+
+        symbols = list(df["symbol"].unique())
+        old = []
+        families = []
+        for i in range(0, len(symbols), 500):
+            chunk = symbols[i:i + 500]
+            placeholders = ",".join(["?"] * len(chunk))
+            curr.execute(
+                "SELECT p.symbol, p.date, COALESCE(a.adj_close, p.close) "
+                "FROM mutual_fund_prices p "
+                "LEFT JOIN adjusted_prices a "
+                "ON a.symbol = p.symbol AND a.date = p.date "
+                "WHERE p.symbol IN ({})".format(placeholders), chunk)
+            old += curr.fetchall()
+            curr.execute(
+                "SELECT f.symbol, f.fund_family FROM mutual_funds f "
+                "WHERE f.symbol IN ({}) AND NOT EXISTS ("
+                "    SELECT 1 FROM inactive_funds i "
+                "    WHERE i.symbol = f.symbol "
+                "    AND i.fund_family = f.fund_family"
+                ")".format(placeholders), chunk)
+            families += curr.fetchall()
+
+        old = pd.DataFrame(old, columns=["symbol", "date", "old"])
+        families = pd.DataFrame(families, columns=["symbol", "fund_family"])
+        delta = df.merge(old, on=["symbol", "date"])
+        delta["delta"] = (
+            delta["adj_close"].astype(float) - delta["old"].astype(float)
+        ).fillna(0.0)
+        delta = delta.merge(families, on="symbol")
+        delta = delta.groupby(["fund_family", "date"])["delta"].sum()
+        delta = delta[delta != 0]
+        return [(float(v), k[0], k[1]) for k, v in delta.items()]
+
+    def replace_adjusted(self, symbols, df):
+        """Write adjusted closes, first dropping all rows of `symbols`.
+
+        The adjusted sums of `family_daily_averages` move along by the
+        difference to what was stored for each row before.
+        """
+        placeholders = ",".join(["?"] * len(symbols))
+        delete = "DELETE FROM adjusted_prices WHERE symbol IN ({})".format(
+            placeholders)
+        insert = (
+            "INSERT OR REPLACE INTO adjusted_prices (symbol, date, adj_close) "
+            "VALUES (?,?,?)"
+        )
+        update = (
+            "UPDATE family_daily_averages SET "
+            "adj_close_sum = adj_close_sum + ?1, "
+            "adj_close_mean = (adj_close_sum + ?1) / close_count "
+            "WHERE fund_family = ?2 AND date = ?3"
+        )
+        df = df[["symbol", "date", "adj_close"]].astype(object)
+        df = df.where(df.notnull(), None)
+        with self.transaction() as curr:
+            deltas = self._adjusted_average_deltas(curr, df)
+            if symbols:
+                curr.execute(delete, list(symbols))
+            curr.executemany(insert, df.itertuples(index=False, name=None))
+            curr.executemany(update, deltas)
 
     def insert_new_mf(self, symbol=None, fund_family=None, name=None):
         query = (
-            "INSERT INTO mutual_funds (symbol, fund_family, name) "
+            "INSERT OR IGNORE INTO mutual_funds (symbol, fund_family, name) "
             "VALUES (?,?,?)"
         )
-        with self.cursor_execute(query, params=[symbol, fund_family, name]) as curr:
-            _ = curr.rowcount
+        with self.transaction() as curr:
+            curr.execute(query, [symbol, fund_family, name])
+
+    def latest_universe_version(self):
+        query = "SELECT MAX(version) FROM universe_versions"
+        with self.cursor_read(query) as curr:
+            return curr.fetchone()[0]
+
+    def load_universe(self, version=None):
+        """family -> {href, fund_page, hashes, symbols} for a version."""
+        if version is None:
+            version = self.latest_universe_version()
+        if version is None:
+            return dict()
+
+        query = (
+            "SELECT fund_family, href, fund_page, family_hash, fund_page_hash "
+            "FROM universe_families WHERE version = ?"
+        )
+        universe = dict()
+        with self.cursor_read(query, params=[version]) as curr:
+            for row in curr.fetchall():
+                universe[row[0]] = {
+                    "family": row[0],
+                    "href": row[1],
+                    "fund_page": row[2],
+                    "family_hash": row[3],
+                    "fund_page_hash": row[4],
+                    "symbols": [],
+                }
+
+        query = (
+            "SELECT symbol, fund_family, name FROM universe_symbols "
+            "WHERE version = ? ORDER BY rowid"
+        )
+        with self.cursor_read(query, params=[version]) as curr:
+            for row in curr.fetchall():
+                universe[row[1]]["symbols"].append({
+                    "symbol": row[0],
+                    "name": row[2],
+                    "fund_family": row[1],
+                })
+        return universe
+
+    def save_universe(self, universe):
+        families = []
+        symbols = []
+        for key, ff in universe.items():
+            families.append([
+                key, ff.get("href"), ff.get("fund_page"),
+                ff.get("family_hash"), ff.get("fund_page_hash"),
+            ])
+            for s in ff.get("symbols") or []:
+                symbols.append([s["symbol"], key, s.get("name")])
+
+        with self.transaction() as curr:
+            curr.execute("SELECT MAX(version) FROM universe_versions")
+            version = (curr.fetchone()[0] or 0) + 1
+            query = "INSERT INTO universe_versions (version) VALUES (?)"
+            curr.execute(query, [version])
+
+            query = (
+                "INSERT INTO universe_families (fund_family, version, href, "
+                "fund_page, family_hash, fund_page_hash) VALUES (?,?,?,?,?,?)"
+            )
+            curr.executemany(query, [f[:1] + [version] + f[1:] for f in families])
+
+            query = (
+                "INSERT INTO universe_symbols (symbol, fund_family, version, "
+                "name) VALUES (?,?,?,?)"
+            )
+            curr.executemany(query, [s[:2] + [version] + s[2:] for s in symbols])
+        return version
+
+    def mark_inactive(self, pairs):
+        """Mark (fund_family, symbol) pairs as closed funds, taking their
+        prices out of the family daily averages."""
+        query = (
+            "INSERT OR IGNORE INTO inactive_funds (symbol, fund_family) "
+            "VALUES (?,?)"
+        )
+        with self.transaction() as curr:
+            for family, symbol in pairs:
+                curr.execute(query, [symbol, family])
+                if curr.rowcount:
+                    self._shift_family_daily_averages(curr, family, symbol, -1)
+
+    def mark_active(self, pairs):
+        query = "DELETE FROM inactive_funds WHERE symbol = ? AND fund_family = ?"
+        with self.transaction() as curr:
+            for family, symbol in pairs:
+                curr.execute(query, [symbol, family])
+                if curr.rowcount:
+                    self._shift_family_daily_averages(curr, family, symbol, 1)
+
+    def inactive_symbols(self):
+        query = "SELECT fund_family, symbol FROM inactive_funds"
+        with self.cursor_read(query) as curr:
+            return set((r[0], r[1]) for r in curr.fetchall())
 
     def clean_column_names(self, columns):
         cleaned = []
@@ -155,12 +780,11 @@ class DB:
         return cleaned
 
     def insert_df(self, df, new=False, params={}):
+        import pandas as pd
+
         if params.get("symbol") is None:
             raise Exception("Invalid Symbol: {}".format(str(params)))
 
-        if new:
-            self.insert_new_mf(**params)
-
         df["symbol"] = params["symbol"]
         df.reset_index(inplace=True)
 
@@ -172,14 +796,54 @@ class DB:
         for c in db_def["columns"]:
             keep_columns.append(c[0])
 
-        idx = []
-        for c in db_def["pk"]:
-            idx.append(c)
+        df = df[keep_columns].copy()
+        df["date"] = pd.to_datetime(df["date"]).dt.strftime("%Y-%m-%d %H:%M:%S")
+        df = df.astype(object).where(df.notnull(), None)
 
-        df = df[keep_columns]
-        df.set_index(idx, inplace=True)
-        df.to_sql(table, self.dbh, if_exists="append")
+        query = "INSERT INTO {t} ({c}) VALUES ({p})".format(
+            t=table,
+            c=",".join(keep_columns),
+            p=",".join(["?"] * len(keep_columns)),
+        )
+        with self.transaction() as curr:
+            if new:
+                self.insert_new_mf(**params)
+            curr.executemany(query, df.itertuples(index=False, name=None))
+            self.update_symbol_summary(params["symbol"], df)
+            if params.get("fund_family"):
+                self.update_family_daily_averages(params["fund_family"], df)
 
     @property
     def all_prices_query(self):
         return "SELECT * FROM mutual_fund_prices WHERE symbol = ?"
+
+    def family_daily_query(self, n_families):
+        placeholders = ",".join(["?"] * n_families)
+        return (
+            "SELECT fund_family, date, close_mean AS close "
+            "FROM family_daily_averages "
+            "WHERE fund_family IN ({}) "
+            "ORDER BY fund_family, date"
+        ).format(placeholders)
+
+    def family_adjusted_daily_query(self, n_families):
+        placeholders = ",".join(["?"] * n_families)
+        return (
+            "SELECT fund_family, date, adj_close_mean AS close "
+            "FROM family_daily_averages "
+            "WHERE fund_family IN ({}) "
+            "ORDER BY fund_family, date"
+        ).format(placeholders)
+
+    def family_prices_query(self, n_symbols, adjusted=False):
+        placeholders = ",".join(["?"] * n_symbols)
+        if adjusted:
+            return (
+                "SELECT p.*, a.adj_close FROM mutual_fund_prices p "
+                "LEFT JOIN adjusted_prices a "
+                "ON a.symbol = p.symbol AND a.date = p.date "
+                "WHERE p.symbol IN ({})"
+            ).format(placeholders)
+        return (
+            "SELECT * FROM mutual_fund_prices WHERE symbol IN ({})"
+        ).format(placeholders)
@@ -0,0 +1,323 @@
+# coding: utf8
+import csv
+import datetime
+import io
+import json
+import os
+import sqlite3
+from urllib.parse import quote
+
+# Rows pulled from the cursor, and written out, at a time.
+CHUNKSIZE = 5000
+
+S = "string"
+F = "float"
+I = "int"
+
+DATASETS = {
+    "rankings": [
+        ("rank", I),
+        ("fund_family", S),
+        ("growth_rate", F),
+        ("start_date", S),
+        ("end_date", S),
+    ],
+    "daily": [
+        ("fund_family", S),
+        ("date", S),
+        ("close", F),
+        ("symbols", I),
+    ],
+    "symbols": [
+        ("symbol", S),
+        ("date", S),
+        ("open", F),
+        ("high", F),
+        ("low", F),
+        ("close", F),
+        ("volume", F),
+    ],
+}
+
+
+def connect(db_path):
+    uri = "file:{}?mode=ro".format(quote(os.path.abspath(db_path)))
+    return sqlite3.connect(uri, uri=True)
+
+
+def _in(column, values):
+    return "{} IN ({})".format(column, ",".join(["?"] * len(values)))
+
+
+def _parse_date(value):
+    try:
+        return datetime.datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+    except ValueError:
+        raise Exception("Invalid date, expected YYYY-MM-DD: {}".format(value))
+
+
+def _where(families=None, symbols=None, start=None, end=None,
+           family_column=None):
+    """WHERE clause over mutual_fund_prices aliased as `p`."""
+    clauses = []
+    params = []
+    if families:
+        if family_column:
+            clauses.append(_in(family_column, families))
+        else:
+            clauses.append(
+                "p.symbol IN (SELECT symbol FROM mutual_funds WHERE {})"
+                .format(_in("fund_family", families))
+            )
+        params += list(families)
+    if symbols:
+        clauses.append(_in("p.symbol", symbols))
+        params += list(symbols)
+    if start:
+        clauses.append("p.date >= ?")
+        params.append(str(_parse_date(start)))
+    if end:
+        # Dates are stored with a time part, compare against the next day.
+        end = _parse_date(end)
+        clauses.append("p.date < ?")
+        params.append(str(end + datetime.timedelta(days=1)))
+
+    if not clauses:
+        return "", params
+    return "WHERE " + " AND ".join(clauses), params
+
+
+def _fetch_chunks(dbh, query, params, chunksize=CHUNKSIZE):
+    curr = dbh.cursor()
+    try:
+        curr.execute(query, params)
+        while True:
+            rows = curr.fetchmany(chunksize)
+            if not rows:
+                break
+            yield rows
+    finally:
+        curr.close()
+
+
+def symbol_chunks(dbh, families=None, symbols=None, start=None, end=None,
+                  chunksize=CHUNKSIZE):
+    where, params = _where(families, symbols, start, end)
+    query = (
+        "SELECT p.symbol, substr(p.date, 1, 10), p.open, p.high, p.low, "
+        "p.close, p.volume "
+        "FROM mutual_fund_prices p "
+        "{where} "
+        "ORDER BY p.symbol, p.date"
+    ).format(where=where)
+    return _fetch_chunks(dbh, query, params, chunksize)
+
+
+def daily_chunks(dbh, families=None, symbols=None, start=None, end=None,
+                 chunksize=CHUNKSIZE):
+    if symbols:
+        # Averages over a subset of symbols aren't materialized.
+        return _daily_chunks_from_prices(dbh, families, symbols, start, end,
+                                         chunksize)
+
+    where, params = _where(families, None, start, end,
+                           family_column="p.fund_family")
+    query = (
+        "SELECT p.fund_family, substr(p.date, 1, 10), p.close_mean, "
+        "p.close_count "
+        "FROM family_daily_averages p "
+        "{where} "
+        "ORDER BY p.fund_family, p.date"
+    ).format(where=where)
+    return _fetch_chunks(dbh, query, params, chunksize)
+
+
+def _daily_chunks_from_prices(dbh, families=None, symbols=None, start=None,
+                              end=None, chunksize=CHUNKSIZE):
+    where, params = _where(families, symbols, start, end,
+                           family_column="f.fund_family")
+    # Closed funds are left out, like in the materialized averages.
+    active = (
+        "NOT EXISTS (SELECT 1 FROM inactive_funds i "
+        "WHERE i.symbol = p.symbol AND i.fund_family = f.fund_family)"
+    )
+    where = (where + " AND " if where else "WHERE ") + active
+    query = (
+        "SELECT f.fund_family, substr(p.date, 1, 10), AVG(p.close), "
+        "COUNT(p.close) "
+        "FROM mutual_fund_prices p "
+        "JOIN mutual_funds f ON f.symbol = p.symbol "
+        "{where} "
+        "GROUP BY f.fund_family, p.date "
+        "ORDER BY f.fund_family, p.date"
+    ).format(where=where)
+    return _fetch_chunks(dbh, query, params, chunksize)
+
+
+def ranking_chunks(dbh, families=None, symbols=None, start=None, end=None,
+                   chunksize=CHUNKSIZE):
+    """Growth of each family's daily average, first to last day.
+
+    Only the first and last day of every family are kept while the daily
+    averages stream past.
+    """
+    first = dict()
+    last = dict()
+    for rows in daily_chunks(dbh, families, symbols, start, end, chunksize):
+        for family, date, close, _ in rows:
+            if close is None:
+                continue
+            if family not in first:
+                first[family] = (date, close)
+            last[family] = (date, close)
+
+    rankings = []
+    for family, (start_date, start_close) in first.items():
+        end_date, end_close = last[family]
+        if start_close:
+            growth_rate = (end_close - start_close) / start_close
+        else:
+            growth_rate = None
+        rankings.append((family, growth_rate, start_date, end_date))
+
+    sort_key = lambda x: (x[1] is not None, x[1] or 0)
+    rankings.sort(key=sort_key, reverse=True)
+
+    rows = [(i + 1,) + r for i, r in enumerate(rankings)]
+    for i in range(0, len(rows), chunksize):
+        yield rows[i:i + chunksize]
+
+
+QUERIES = {
+    "rankings": ranking_chunks,
+    "daily": daily_chunks,
+    "symbols": symbol_chunks,
+}
+
+
+def write_csv(columns, chunks):
+    yield (",".join(c[0] for c in columns) + "\r\n").encode("utf-8")
+    for rows in chunks:
+        buf = io.StringIO()
+        csv.writer(buf).writerows(rows)
+        yield buf.getvalue().encode("utf-8")
+
+
+def write_ndjson(columns, chunks):
+    names = [c[0] for c in columns]
+    for rows in chunks:
+        lines = [json.dumps(dict(zip(names, r))) for r in rows]
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands out what was written so far.
+
+    The parquet writer records absolute offsets in the footer, so the
+    position has to keep counting even after the buffer is drained.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        b = bytes(b)
+        self.parts.append(b)
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        out = b"".join(self.parts)
+        self.parts = []
+        return out
+
+
+def write_parquet(columns, chunks):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception("Parquet export requires pyarrow")
+
+    types = {S: pa.string(), F: pa.float64(), I: pa.int64()}
+    schema = pa.schema([(c[0], types[c[1]]) for c in columns])
+
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    for rows in chunks:
+        arrays = [
+            pa.array([r[i] for r in rows], type=schema.types[i])
+            for i in range(len(columns))
+        ]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+FORMATS = {
+    "csv": (write_csv, "text/csv"),
+    "ndjson": (write_ndjson, "application/x-ndjson"),
+    "parquet": (write_parquet, "application/octet-stream"),
+}
+
+
+def export(dbh, dataset, fmt, families=None, symbols=None, start=None,
+           end=None, chunksize=CHUNKSIZE):
+    """Yield `dataset` encoded as `fmt`, chunk by chunk, as bytes."""
+    if dataset not in DATASETS:
+        raise Exception("Unknown dataset: {}".format(dataset))
+    if fmt not in FORMATS:
+        raise Exception("Unknown format: {}".format(fmt))
+    # Checked here, a bad date inside a streaming response can't become
+    # an error status any more.
+    for date in (start, end):
+        if date:
+            _parse_date(date)
+
+    chunks = QUERIES[dataset](dbh, families, symbols, start, end, chunksize)
+    writer = FORMATS[fmt][0]
+    return writer(DATASETS[dataset], chunks)
+
+
+def _split(value):
+    if not value:
+        return None
+    return [v for v in value.split(",") if v]
+
+
+def register_routes(server, db):
+    """Serve `/export/<dataset>.<fmt>` from the Dash app's Flask server.
+
+    Filters are query args: family and symbol (comma separated), start
+    and end (YYYY-MM-DD). Rows are read through the request thread's
+    read-only connection from `db`.
+    """
+    from flask import Response, abort, request, stream_with_context
+
+    @server.route("/export/<dataset>.<fmt>")
+    def export_dataset(dataset, fmt):
+        if dataset not in DATASETS or fmt not in FORMATS:
+            abort(404)
+
+        try:
+            chunks = export(
+                db.reader(), dataset, fmt,
+                families=_split(request.args.get("family")),
+                symbols=_split(request.args.get("symbol")),
+                start=request.args.get("start"),
+                end=request.args.get("end"),
+            )
+        except Exception as e:
+            abort(400, str(e))
+        return Response(stream_with_context(chunks),
+                        mimetype=FORMATS[fmt][1])
+
+    return server
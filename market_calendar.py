@@ -0,0 +1,114 @@
+# coding: utf8
+import datetime
+from functools import lru_cache
+
+from dateutil import tz
+from dateutil.easter import easter
+from dateutil.relativedelta import relativedelta, MO, TH
+
+EASTERN = tz.gettz("America/New_York")
+
+# Fund companies report NAVs to NASDAQ by ~5:50pm ET, give it until 6pm.
+NAV_PUBLISHED = datetime.time(18, 0)
+
+# One-off closures that don't follow any rule.
+SPECIAL_CLOSURES = {
+    datetime.date(2018, 12, 5),  # President G.H.W. Bush
+    datetime.date(2025, 1, 9),   # President Carter
+}
+
+
+def _observed(d):
+    if d.weekday() == 5:
+        return d - datetime.timedelta(days=1)
+    if d.weekday() == 6:
+        return d + datetime.timedelta(days=1)
+    return d
+
+
+@lru_cache(maxsize=64)
+def nyse_holidays(year):
+    jan1 = datetime.date(year, 1, 1)
+    holidays = {
+        jan1 + relativedelta(weekday=MO(+3)),
+        datetime.date(year, 2, 1) + relativedelta(weekday=MO(+3)),
+        easter(year) - datetime.timedelta(days=2),
+        datetime.date(year, 5, 31) + relativedelta(weekday=MO(-1)),
+        _observed(datetime.date(year, 7, 4)),
+        datetime.date(year, 9, 1) + relativedelta(weekday=MO(+1)),
+        datetime.date(year, 11, 1) + relativedelta(weekday=TH(+4)),
+        _observed(datetime.date(year, 12, 25)),
+    }
+    # NYSE doesn't close on Dec 31 when Jan 1 is a Saturday.
+    if jan1.weekday() != 5:
+        holidays.add(_observed(jan1))
+    if year >= 2022:
+        holidays.add(_observed(datetime.date(year, 6, 19)))
+    holidays.update(d for d in SPECIAL_CLOSURES if d.year == year)
+    return frozenset(holidays)
+
+
+def is_trading_day(d):
+    return d.weekday() < 5 and d not in nyse_holidays(d.year)
+
+
+def previous_trading_day(d):
+    d = d - datetime.timedelta(days=1)
+    while not is_trading_day(d):
+        d -= datetime.timedelta(days=1)
+    return d
+
+
+def next_trading_day(d):
+    d = d + datetime.timedelta(days=1)
+    while not is_trading_day(d):
+        d += datetime.timedelta(days=1)
+    return d
+
+
+def eastern_now():
+    return datetime.datetime.now(EASTERN)
+
+
+def latest_nav_date(now=None):
+    """The most recent trading day whose NAV has been published by `now`."""
+    now = now or eastern_now()
+    if now.tzinfo is not None:
+        now = now.astimezone(EASTERN)
+
+    today = now.date()
+    if is_trading_day(today) and now.time() >= NAV_PUBLISHED:
+        return today
+    return previous_trading_day(today)
+
+
+def is_due(last_date, now=None):
+    """Can there be a price newer than `last_date` (None = never fetched)?"""
+    if last_date is None:
+        return True
+    return last_date < latest_nav_date(now)
+
+
+def schedule_refresh(symbols, last_dates, start_date, now=None,
+                     last_lookups=None):
+    """Map each symbol that is due to the first date worth requesting.
+
+    `last_dates` maps symbol -> last stored price date. Symbols that are
+    up to date with the latest published NAV are left out entirely, and
+    so are symbols in `last_lookups` (symbol -> NAV date of the last
+    request) already asked for since then, whether or not that returned
+    anything.
+    """
+    latest = latest_nav_date(now)
+    last_lookups = last_lookups or dict()
+    due = dict()
+    for symbol in symbols:
+        last_lookup = last_lookups.get(symbol)
+        if last_lookup is not None and last_lookup >= latest:
+            continue
+        last_date = last_dates.get(symbol)
+        if last_date is None:
+            due[symbol] = start_date
+        elif last_date < latest:
+            due[symbol] = next_trading_day(last_date)
+    return due
@@ -0,0 +1,214 @@
+# coding: utf8
+
+# SQL expression for the last calendar day of the bucket holding `date`,
+# per resolution. Every series in a bucket is plotted at that same day,
+# and a week ending on a Friday never gets split at the turn of a year.
+RESOLUTIONS = {
+    "D": "date(date)",
+    "W": "date(date, 'weekday 5')",
+    "M": "date(date, 'start of month', '+1 month', '-1 day')",
+    "Q": (
+        "date(date, 'start of month', "
+        "'+' || (3 - (CAST(strftime('%m', date) AS INTEGER) - 1) % 3) "
+        "|| ' months', '-1 day')"
+    ),
+}
+
+TABLE_COLUMNS = [
+    "symbol",
+    "name",
+    "fund_family",
+    "first_date",
+    "last_date",
+    "close",
+    "growth_rate",
+]
+TEXT_COLUMNS = {"symbol", "name", "fund_family", "first_date", "last_date"}
+
+SUMMARY = (
+    "WITH summary AS ("
+    "    SELECT f.symbol, f.name, f.fund_family, "
+    "        substr(s.first_date, 1, 10) AS first_date, "
+    "        substr(s.last_date, 1, 10) AS last_date, "
+    "        s.last_close AS close, "
+    "        (s.last_close - s.first_close) / s.first_close AS growth_rate "
+    "    FROM mutual_funds f "
+    "    JOIN symbol_summaries s ON s.symbol = f.symbol"
+    ") "
+)
+
+# Growth from the adjusted closes of the first and last day instead.
+ADJUSTED_SUMMARY = (
+    "WITH summary AS ("
+    "    SELECT f.symbol, f.name, f.fund_family, "
+    "        substr(s.first_date, 1, 10) AS first_date, "
+    "        substr(s.last_date, 1, 10) AS last_date, "
+    "        s.last_close AS close, "
+    "        (COALESCE(al.adj_close, s.last_close) "
+    "         - COALESCE(af.adj_close, s.first_close)) "
+    "        / COALESCE(af.adj_close, s.first_close) AS growth_rate "
+    "    FROM mutual_funds f "
+    "    JOIN symbol_summaries s ON s.symbol = f.symbol "
+    "    LEFT JOIN adjusted_prices af "
+    "        ON af.symbol = s.symbol AND af.date = s.first_date "
+    "    LEFT JOIN adjusted_prices al "
+    "        ON al.symbol = s.symbol AND al.date = s.last_date"
+    ") "
+)
+
+ADJUSTED_PRICES = (
+    "(SELECT p.symbol, p.date, COALESCE(a.adj_close, p.close) AS close "
+    "FROM mutual_fund_prices p "
+    "LEFT JOIN adjusted_prices a ON a.symbol = p.symbol AND a.date = p.date)"
+)
+
+
+def _in(column, values):
+    return "{} IN ({})".format(column, ",".join(["?"] * len(values)))
+
+
+def _numeric_filter(column, term):
+    """'>1.5', '<=0', '=3' or a bare number."""
+    for op in (">=", "<=", ">", "<", "="):
+        if term.startswith(op):
+            return "{} {} ?".format(column, op), float(term[len(op):])
+    return "{} = ?".format(column), float(term)
+
+
+class QueryEngine:
+    """Answers the Dash callbacks straight from the db.
+
+    Everything is filtered, downsampled, sorted and paginated in sqlite
+    on top of the (symbol, date) and (fund_family, date) keys, so only
+    what is drawn or shown reaches Python. With `adjusted` closes and
+    growth rates are dividend adjusted.
+    """
+
+    def __init__(self, db, adjusted=False):
+        self.db = db
+        self.adjusted = adjusted
+        self.summary = ADJUSTED_SUMMARY if adjusted else SUMMARY
+
+    def _date_range(self, start, end):
+        clauses = []
+        params = []
+        if start:
+            clauses.append("date >= ?")
+            params.append(str(start)[:10])
+        if end:
+            clauses.append("date <= ?")
+            params.append(str(end)[:10] + " 23:59:59")
+        return clauses, params
+
+    def _downsample(self, table, key, value, keys, start, end, resolution):
+        import pandas as pd
+
+        if resolution not in RESOLUTIONS:
+            raise Exception("Invalid resolution: {}".format(resolution))
+
+        clauses, params = self._date_range(start, end)
+        clauses.insert(0, _in(key, keys))
+        params = list(keys) + params
+
+        # sqlite returns `value` from the row holding MAX(date), so each
+        # bucket is represented by its last observation, dated at the end
+        # of the bucket.
+        query = (
+            "SELECT {key} AS key, {bucket} AS bucket, MAX(date) AS last, "
+            "{value} AS close "
+            "FROM {table} "
+            "WHERE {where} "
+            "GROUP BY {key}, bucket "
+            "ORDER BY {key}, bucket"
+        ).format(key=key, value=value, table=table,
+                 where=" AND ".join(clauses), bucket=RESOLUTIONS[resolution])
+        df = pd.read_sql_query(query, self.db.reader(), params=params)
+        df = df.rename(columns={"bucket": "date"})
+        return df[["key", "date", "close"]]
+
+    def series(self, families=None, symbols=None, start=None, end=None,
+               resolution="D"):
+        """Aligned close series: columns `key`, `kind`, `date`, `close`.
+
+        Families come from the materialized daily averages, symbols from
+        their prices.
+        """
+        import pandas as pd
+
+        out = []
+        if families:
+            value = "adj_close_mean" if self.adjusted else "close_mean"
+            df = self._downsample("family_daily_averages", "fund_family",
+                                  value, families, start, end, resolution)
+            df["kind"] = "fund_family"
+            out.append(df)
+        if symbols:
+            table = ADJUSTED_PRICES if self.adjusted else "mutual_fund_prices"
+            df = self._downsample(table, "symbol", "close",
+                                  symbols, start, end, resolution)
+            df["kind"] = "symbol"
+            out.append(df)
+        if not out:
+            return pd.DataFrame(columns=["key", "date", "close", "kind"])
+        return pd.concat(out, ignore_index=True)
+
+    def _table_where(self, families, filters):
+        clauses = []
+        params = []
+        if families:
+            clauses.append(_in("fund_family", families))
+            params += list(families)
+        for column, term in (filters or {}).items():
+            term = str(term).strip()
+            if column not in TABLE_COLUMNS or not term:
+                continue
+            if column in TEXT_COLUMNS:
+                clauses.append("{} LIKE ?".format(column))
+                params.append("%" + term + "%")
+                continue
+            try:
+                clause, value = _numeric_filter(column, term)
+            except ValueError:
+                continue
+            clauses.append(clause)
+            params.append(value)
+
+        if not clauses:
+            return "", params
+        return "WHERE " + " AND ".join(clauses), params
+
+    def table_count(self, filters=None, families=None):
+        where, params = self._table_where(families, filters)
+        query = self.summary + "SELECT COUNT(*) FROM summary {where}".format(
+            where=where)
+        with self.db.cursor_read(query, params=params) as curr:
+            return curr.fetchone()[0]
+
+    def table_page(self, page=0, page_size=25, sort_column=None,
+                   sort_direction="DESC", filters=None, families=None):
+        """One page of the per-symbol summary, as a list of row dicts.
+
+        `filters` maps column -> term, a substring for text columns and an
+        optional comparison ('>0.1') for numeric ones.
+        """
+        where, params = self._table_where(families, filters)
+
+        if sort_column not in TABLE_COLUMNS:
+            sort_column = "growth_rate"
+        if str(sort_direction).upper() == "ASC":
+            sort_direction = "ASC"
+        else:
+            sort_direction = "DESC"
+
+        query = (
+            self.summary +
+            "SELECT {columns} FROM summary {where} "
+            "ORDER BY {sort} {direction}, symbol "
+            "LIMIT ? OFFSET ?"
+        ).format(columns=",".join(TABLE_COLUMNS), where=where,
+                 sort=sort_column, direction=sort_direction)
+
+        page = max(int(page or 0), 0)
+        params = params + [page_size, page * page_size]
+        with self.db.cursor_read(query, params=params) as curr:
+            return [dict(zip(TABLE_COLUMNS, r)) for r in curr.fetchall()]
@@ -1,26 +1,24 @@
 # coding: utf8
-from bs4 import BeautifulSoup
 import datetime
-from dateutil.relativedelta import relativedelta
 import re
-import requests_cache
-import requests
-
-from requests.exceptions import ConnectionError
-
-import numpy as np
-import pandas as pd
-import pandas_datareader.data as web
 
 from time import time
 
 from db import DB
+from market_calendar import latest_nav_date, schedule_refresh
 from utils import (
     cache_path,
+    pickled_page_age,
     pickled_page_exists,
     pickle_response,
     load_pickled_page,
 )
+from universe import (
+    diff_universe,
+    is_unchanged,
+    merge_universe,
+    page_hash,
+)
 
 
 FUND_FAMILIES = "http://quicktake.morningstar.com/fundfamily/0C00001Z4B/all-fund-family.aspx"
@@ -29,22 +27,35 @@ MORNINGSTAR = "http://quicktake.morningstar.com"
 CACHE_PATH = cache_path()
 EXPIRE_AFTER = datetime.timedelta(days=7)
 
+# Family and fund pages older than this are downloaded again, so that a
+# plain refresh notices funds that were added or closed.
+PAGE_MAX_AGE = datetime.timedelta(days=1)
+
 split_new_line = lambda x: x.split("\n")[0]
-soupit = lambda x: BeautifulSoup(x, "html.parser")
+
+
+def soupit(content):
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(content, "html.parser")
 
 
 class MFScraper:
     def __init__(self, db_path, ds, cache_path, cache_expire_days,
-                 start_date, end_date, limit=[]):
-        self.db=DB(db_path)
+                 start_date, end_date, limit=[], processes=None, db=None,
+                 adjusted=False):
+        self.db_path=db_path
         self.ds=ds
+        self.cache_path=cache_path
         self.cache_expire_days=datetime.timedelta(days=cache_expire_days)
-        self.session = requests_cache.CachedSession(cache_name=cache_path,
-                                                    backend="sqlite",
-                                                    expire_after=self.cache_expire_days)
+        self._db = db
+        self._session = None
+        self.families = dict()
+        self.fund_families = dict()
         self.start_date = start_date
         self.end_date = end_date
         self.limit = limit
+        self.processes = processes
+        self.adjusted = adjusted
         self.ignore = {
             "families": [
                 "TOPS",
@@ -58,7 +69,27 @@ class MFScraper:
             ]
         }
 
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = DB(self.db_path)
+        return self._db
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests_cache
+            self._session = requests_cache.CachedSession(
+                cache_name=self.cache_path,
+                backend="sqlite",
+                expire_after=self.cache_expire_days
+            )
+        return self._session
+
     def scrape(self, symbol, start_date, end_date):
+        import pandas_datareader.data as web
+
+        nav_date = latest_nav_date()
         try:
             response = web.DataReader(symbol, self.ds, start_date,
                                       end_date, session=self.session)
@@ -67,18 +98,34 @@ class MFScraper:
                 "Could not retrieve prices for: {}, using {}"
                 .format(symbol,self.ds)
             )
+            response = None
+        # Answered requests count even without data, or a dead symbol is
+        # asked for again on every run. Network errors propagate unlogged
+        # so the symbol is retried.
+        self.db.log_symbol_lookup(symbol, nav_date)
+        return response
+
+    def scrape_actions(self, symbol, start_date, end_date):
+        """Dividends and splits of `symbol` (yahoo-actions)."""
+        import pandas_datareader.data as web
+
+        try:
+            response = web.DataReader(symbol, "yahoo-actions", start_date,
+                                      end_date, session=self.session)
+        except KeyError:
+            print("Could not retrieve actions for: {}".format(symbol))
             return None
-        self.db.log_symbol_lookup(symbol)
         return response
 
-    def _load_fund_families_table(self):
-        self._ensure_pickle(FUND_FAMILIES)
+    def _load_fund_families_table(self, refresh=False):
+        self._ensure_pickle(FUND_FAMILIES, refresh=refresh)
         content = load_pickled_page(FUND_FAMILIES)
         soup = soupit(content)
         return soup.find("table")
 
-    def get_fund_families(self):
-        table = self._load_fund_families_table()
+    def get_fund_families(self, refresh=False):
+        table = self._load_fund_families_table(refresh=refresh)
+        self.families = self._find_all_fund_families(table)
 
         if self.limit:
             fund_families = self._find_specific_fund_families(table, self.limit)
@@ -105,16 +152,22 @@ class MFScraper:
     def _find_all_fund_families(self, table):
         fund_families = dict()
         for link in table.find_all("a"):
-            if link.get_text() and link.get_text() not in self.ignore["families"]:
+            link_name = link.get_text()
+            if link_name and link_name not in self.ignore["families"]:
+                link_name = str(link_name)
                 href = split_new_line(link["href"])
-                fund_families[str(link.get_text())] = {
+                fund_families[link_name] = {
                         "href": href,
                         "family": link_name,
                     }
         return fund_families
 
-    def _ensure_pickle(self, url):
-        if not pickled_page_exists(url):
+    def _ensure_pickle(self, url, refresh=False):
+        age = pickled_page_age(url)
+        if refresh or age is None or age > PAGE_MAX_AGE:
+            import requests
+            from requests.exceptions import ConnectionError
+
             try:
                 response = requests.get(url)
             except ConnectionError:
@@ -177,59 +230,93 @@ class MFScraper:
                 seen.add(s)
         return symbols
 
-    def _find_last_lookup(self, symbol):
-        last_symbol_lookup = self.db.last_symbol_lookup(symbol)
-        if last_symbol_lookup is None:
-            return (None, None)
-        return last_symbol_lookup
-
     def add_columns_to_df(self, df, d={}):
         for k, v in d.items():
             df[k] = v
         return df
 
     def get_symbol_prices(self, fund_family):
+        """Prices for a family, only asking upstream for symbols that can
+        have a newer NAV than the one stored (see `market_calendar`).
+
+        With `adjusted` the family's adjusted closes are brought up to
+        date and returned as `adj_close`.
+        """
+        import pandas as pd
+
         symbols = fund_family["symbols"]
         if not symbols:
             return None
 
+        inactive = self.db.inactive_symbols()
+        symbols = [
+            s for s in symbols
+            if (fund_family.get("family"), s["symbol"]) not in inactive
+        ]
+        if not symbols:
+            return None
+
+        names = [s["symbol"] for s in symbols]
+        last_dates = self.db.last_price_dates(names)
+        last_lookups = self.db.last_symbol_lookups(names)
+        due = schedule_refresh(names, last_dates, self.start_date,
+                               last_lookups=last_lookups)
+
         prices = []
         for symbol_dict in symbols:
-
-            # Find all dates we have first.
-            last_lookup_day = self._find_last_lookup(symbol_dict["symbol"])
-            if last_lookup_day[0] is None:
-                # First time seeing this symbol.
-                df_new = self.scrape(
-                    symbol_dict["symbol"],
-                    self.start_date,
-                    self.end_date
-                )
+            symbol = symbol_dict["symbol"]
+
+            if symbol not in last_dates:
+                # No prices yet, and already asked for since the last NAV.
+                if symbol not in due:
+                    continue
+                df_new = self.scrape(symbol, self.start_date, self.end_date)
+                if df_new is None or not len(df_new):
+                    continue
                 df_new = self.add_columns_to_df(df_new, symbol_dict)
                 self.db.insert_df(df_new, new=True, params=symbol_dict)
                 prices.append(df_new)
                 continue
 
-
             query = self.db.all_prices_query
-            params = [symbol_dict["symbol"]]
-            df = pd.read_sql_query(query, self.db.dbh, params=params)
+            params = [symbol]
+            df = pd.read_sql_query(query, self.db.reader(), params=params)
             df = self.add_columns_to_df(df, symbol_dict)
 
-            # 0 day difference - Just pull from db.
-            if int(last_lookup_day[0]) <= 1:
-                self.logit(time(), symbol_dict["symbol"], "cache_only")
+            # Nothing can have been published since - Just pull from db.
+            if symbol not in due or due[symbol] > self.end_date:
+                self.logit(time(), symbol, "cache_only")
                 prices.append(df)
                 continue
-            start_date = missing_dates[1]
-            df_new = self.scrape(symbol_dict["symbol"], start_date, self.end_date)
-            if df_new is not None:
+
+            df_new = self.scrape(symbol, due[symbol], self.end_date)
+            if df_new is not None and len(df_new):
                 df_new = self.add_columns_to_df(df_new, symbol_dict)
                 self.db.insert_df(df_new, params=symbol_dict)
                 df = pd.concat([df, df_new])
 
             prices.append(df)
-        return pd.concat(prices)
+
+        if not prices:
+            return None
+        prices = pd.concat(prices)
+        if self.adjusted:
+            prices = self._with_adjusted(prices, names)
+        return prices
+
+    def _with_adjusted(self, df, symbols):
+        from adjustments import update_adjusted_prices
+        import pandas as pd
+
+        update_adjusted_prices(self, symbols)
+        adjusted = self.db.adjusted_frame(symbols)
+
+        # Scraped rows carry timestamps, stored ones text. Yahoo's own
+        # `Adj Close` comes along as `adj_close` and is replaced by ours.
+        df = df.drop(columns=["adj_close"], errors="ignore")
+        df = df.assign(date=pd.to_datetime(df["date"]))
+        adjusted["date"] = pd.to_datetime(adjusted["date"])
+        return df.merge(adjusted, on=["symbol", "date"], how="left")
 
     def insert_df(self, df, new=False, params={}):
         table = "symbol_dates"
@@ -262,14 +349,155 @@ class MFScraper:
         duration = "{:<10.4}".format(time() - start).strip()
         print(msg.format(d=duration, k=key))
 
-    def run_all(self):
-        self.fund_families = self.get_fund_families()
+    def load_universe(self):
+        """Rebuild the discovered families from the latest universe
+        version in the db, without touching any HTML.
+
+        Returns False when nothing was discovered yet, or when it does not
+        cover every family requested through `limit`.
+        """
+        fund_families = self.db.load_universe()
+        if not fund_families:
+            return False
+
+        if self.limit:
+            matches = [
+                [k for k in fund_families if re.match(li, k, re.IGNORECASE)]
+                for li in self.limit
+            ]
+            if not all(matches):
+                return False
+            selected = set(k for m in matches for k in m)
+            fund_families = {
+                k: ff for k, ff in fund_families.items() if k in selected
+            }
+
+        self.fund_families = fund_families
+        return True
+
+    def _page_hash(self, url, refresh=False):
+        self._ensure_pickle(url, refresh=refresh)
+        if not pickled_page_exists(url):
+            return None
+        return page_hash(load_pickled_page(url))
+
+    def discover(self, rediscover=False):
+        """Find families, fund pages and symbols.
+
+        Pages whose content hash matches the last stored universe version
+        are not parsed again. Pickled pages are downloaded again once
+        they are older than `PAGE_MAX_AGE`, `rediscover` downloads every
+        page afresh regardless.
+        """
+        previous = self.db.load_universe()
+        self.fund_families = self.get_fund_families(refresh=rediscover)
+
         for key, ff in self.fund_families.items():
-            self.fund_families[key]["fund_page"] = self.get_fund_page(ff)
-            self.fund_families[key]["symbols"] = (
-                self.get_all_symbols(self.fund_families[key])
+            old = previous.get(key, dict())
+
+            url = MORNINGSTAR + ff["href"]
+            ff["family_hash"] = self._page_hash(url, refresh=rediscover)
+            if old and old["family_hash"] == ff["family_hash"]:
+                ff["fund_page"] = old["fund_page"]
+            else:
+                ff["fund_page"] = self.get_fund_page(ff)
+
+            ff["fund_page_hash"] = None
+            if ff["fund_page"] is not None:
+                url = MORNINGSTAR + ff["fund_page"]
+                ff["fund_page_hash"] = self._page_hash(url, refresh=rediscover)
+
+            unchanged = (
+                old
+                and old["fund_page"] == ff["fund_page"]
+                and old["fund_page_hash"] == ff["fund_page_hash"]
             )
+            if unchanged:
+                ff["symbols"] = old["symbols"]
+            else:
+                ff["symbols"] = self.get_all_symbols(ff)
+
+        universe = merge_universe(previous, self.fund_families,
+                                  complete=not self.limit)
+        self._update_universe(previous, universe)
+
+    def _update_universe(self, previous, universe):
+        diff = diff_universe(previous, universe)
+        if previous and is_unchanged(diff):
+            print("Fund universe unchanged.")
+            return diff
+
+        version = self.db.save_universe(universe)
+        self.db.mark_inactive(diff["removed"])
+        self.db.mark_active(diff["added"])
+
+        print(
+            "Fund universe v{v}: {a} added, {r} removed, {c} families changed"
+            .format(v=version, a=len(diff["added"]), r=len(diff["removed"]),
+                    c=len(diff["changed_families"]))
+        )
+        if previous:
+            for family, symbol in diff["added"]:
+                print("  + {} ({})".format(symbol, family))
+            for family, symbol in diff["removed"]:
+                print("  - {} ({})".format(symbol, family))
+        return diff
+
+    def family_prices(self, key):
+        """One family's price frame, from memory if a run populated it,
+        otherwise straight from the db without keeping it around."""
+        prices = self.fund_families[key].get("prices")
+        if prices is not None:
+            return prices
+        return self._read_family_prices(key, self.db.inactive_symbols())
+
+    def _read_family_prices(self, key, inactive):
+        import pandas as pd
+
+        symbols = [
+            s for s in self.fund_families[key].get("symbols") or []
+            if (key, s["symbol"]) not in inactive
+        ]
+        if not symbols:
+            return None
 
+        query = self.db.family_prices_query(len(symbols),
+                                            adjusted=self.adjusted)
+        params = [s["symbol"] for s in symbols]
+        df = pd.read_sql_query(query, self.db.reader(), params=params)
+        names = {s["symbol"]: s["name"] for s in symbols}
+        df["name"] = df["symbol"].map(names)
+        df["fund_family"] = key
+        return df if len(df) else None
+
+    def family_daily(self, families, adjusted=None):
+        """family -> precomputed daily average close (`date`, `close`).
+
+        With `adjusted` the averages are of dividend/split adjusted
+        closes, materialized alongside the raw ones.
+        """
+        import pandas as pd
+
+        if adjusted is None:
+            adjusted = self.adjusted
+
+        families = list(families)
+        out = dict()
+        # Stay under sqlite's limit on bound parameters.
+        for i in range(0, len(families), 500):
+            chunk = families[i:i + 500]
+            if adjusted:
+                query = self.db.family_adjusted_daily_query(len(chunk))
+            else:
+                query = self.db.family_daily_query(len(chunk))
+            df = pd.read_sql_query(query, self.db.reader(), params=chunk)
+            for family, daily in df.groupby("fund_family", sort=False):
+                out[family] = daily[["date", "close"]].reset_index(drop=True)
+        return out
+
+    def run_all(self, rediscover=False):
+        self.discover(rediscover=rediscover)
+        for key, ff in self.fund_families.items():
             start = time()
             self.fund_families[key]["prices"] = (
                 self.get_symbol_prices(self.fund_families[key])
@@ -280,32 +508,68 @@ class MFScraper:
               self.logit(start, key, "error")
 
     def merge_symbols_to_daily(self, df, dataframe=False):
-        df.reset_index(inplace=True)
+        import pandas as pd
+
+        if "date" not in df.columns:
+            df = df.reset_index()
         avgs = df.groupby(["date"])["close"].mean()
         if dataframe:
             return pd.DataFrame(avgs).reset_index()
         return avgs
 
     def _growth_rate(self, df):
-        avgs = self.merge_symbols_to_daily(df)
-        growth_rate = (avgs[-1] - avgs[0]) / avgs[0]
-        return growth_rate
-
-    def top_fund_families(self, n=5):
+        from analytics import family_arrays, growth_rate
+        return growth_rate(*family_arrays(df))
+
+    def top_fund_families(self, n=5, processes=None, adjusted=None):
+        """Rank families by growth rate.
+
+        Reads the materialized daily averages kept up to date by
+        `DB.insert_df`. Large universes are sharded over a process pool
+        whose workers read their families from the db themselves,
+        `processes=1` forces the serial path. Both give the same ranking.
+        `adjusted` ranks by dividend/split adjusted closes instead.
+        Families without any growth rate (no prices, or a zero first
+        close) come last.
+        """
+        import numpy as np
+
+        from analytics import family_arrays, family_growth_rates, growth_rate
+
+        if adjusted is None:
+            adjusted = self.adjusted
         n = min(n, len(self.fund_families))
+        processes = processes or self.processes
+
+        column = "adj_close_mean" if adjusted else "close_mean"
+        rates = family_growth_rates(self.db, self.fund_families.keys(),
+                                    column=column, processes=processes)
 
         growth_rates = []
-        for k in self.fund_families.keys():
-            growth_rate = self._growth_rate(self.fund_families[k]["prices"])
-            growth_rates.append({
-                "fund_family": k,
-                "growth_rate": growth_rate,
-            })
-        sort_key = lambda x: x["growth_rate"]
+        for k, ff in self.fund_families.items():
+            if k in rates:
+                rate = rates[k]
+            elif ff.get("prices") is not None:
+                rate = growth_rate(*family_arrays(ff["prices"]))
+            else:
+                continue
+            growth_rates.append({"fund_family": k, "growth_rate": rate})
+
+        sort_key = lambda x: (
+            np.isfinite(x["growth_rate"]),
+            x["growth_rate"] if np.isfinite(x["growth_rate"]) else 0,
+        )
         return sorted(growth_rates, key=sort_key, reverse=True)[:n]
 
-    def winners_losers(self, df):
+    def winners_losers(self, df, adjusted=None):
         #XXX TODO `top_fund_families` should use this.
+        import numpy as np
+        import pandas as pd
+
+        if adjusted is None:
+            adjusted = self.adjusted
+        if adjusted and "adj_close" in df.columns:
+            df = df.assign(close=df["adj_close"].fillna(df["close"]))
 
         unique_symbols = df.symbol.unique()
         size = 5
@@ -382,6 +646,7 @@ class MFScraper:
         return df[keep]
 
     def combine_dataframes(self, dfs):
+        import pandas as pd
         return pd.concat(dfs)
 
     def list_all_fund_families(self):
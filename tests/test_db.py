@@ -0,0 +1,75 @@
+# coding: utf8
+import pandas as pd
+import pytest
+
+from adjustments import DIVIDEND, _adjust, _to_datetime, event_factors
+from db import DB
+
+AVERAGES = (
+    "SELECT fund_family, date, close_sum, close_count, close_mean, "
+    "adj_close_sum, adj_close_mean FROM family_daily_averages "
+    "ORDER BY fund_family, date"
+)
+
+
+def price_frame(dates, close):
+    return pd.DataFrame(
+        {
+            "High": close, "Low": close, "Open": close, "Close": close,
+            "Volume": 0.0,
+        },
+        index=pd.Index(pd.to_datetime(dates), name="Date"),
+    )
+
+
+def averages(db):
+    with db.cursor_read(AVERAGES) as curr:
+        return curr.fetchall()
+
+
+def assert_same_rows(actual, expected):
+    assert len(actual) == len(expected)
+    for got, want in zip(actual, expected):
+        assert got[:2] == want[:2]
+        assert got[2:] == pytest.approx(want[2:], nan_ok=True)
+
+
+def test_incremental_averages_match_rebuild(tmp_path):
+    db = DB(str(tmp_path / "mf.sqlite"))
+    family = "F"
+
+    dates = pd.date_range("2020-01-01", periods=6)
+    db.insert_df(price_frame(dates, [10.0, 11.0, 12.0, 13.0, 14.0, 15.0]),
+                 new=True, params={"symbol": "A", "fund_family": family,
+                                   "name": "Fund A"})
+    db.insert_df(price_frame(dates[2:], [20.0, 21.0, 22.0, 23.0]),
+                 new=True, params={"symbol": "B", "fund_family": family,
+                                   "name": "Fund B"})
+    with db.transaction():
+        _adjust(db, ["A", "B"], full_history=False)
+
+    # Closed funds leave the averages, new prices of open ones join them.
+    db.mark_inactive([(family, "B")])
+    db.insert_df(price_frame(dates[-1:] + pd.Timedelta(days=1), [16.0]),
+                 params={"symbol": "A", "fund_family": family})
+
+    # A dividend re-adjusts A's whole history.
+    events = pd.DataFrame({
+        "symbol": ["A"], "date": [dates[3]], "action": [DIVIDEND],
+        "value": [1.2],
+    })
+    with db.transaction():
+        events = event_factors(events, _to_datetime(db.prices_frame(["A"])))
+        db.insert_events(events)
+        _adjust(db, ["A"], full_history=True, new_events=events)
+
+    db.mark_active([(family, "B")])
+    with db.transaction():
+        _adjust(db, ["A", "B"], full_history=False)
+
+    incremental = averages(db)
+    adjusted = [r for r in incremental if r[0] == family]
+    assert any(r[5] != r[2] for r in adjusted)
+
+    db.rebuild_family_daily_averages()
+    assert_same_rows(incremental, averages(db))
@@ -0,0 +1,65 @@
+# coding: utf8
+import datetime
+
+import pandas as pd
+
+from scraper import MFScraper
+
+
+def yahoo_frame(dates, close):
+    return pd.DataFrame(
+        {
+            "High": close, "Low": close, "Open": close, "Close": close,
+            "Volume": 0.0, "Adj Close": close,
+        },
+        index=pd.Index(pd.to_datetime(dates), name="Date"),
+    )
+
+
+def test_get_symbol_prices_adjusted_after_scrape(tmp_path):
+    dates = pd.date_range("2020-01-01", periods=10)
+    mf_scraper = MFScraper(
+        str(tmp_path / "mf.sqlite"), "yahoo", str(tmp_path / "cache"), 7,
+        datetime.date(2020, 1, 1), datetime.date(2020, 1, 10), adjusted=True,
+    )
+
+    def scrape(symbol, start_date, end_date):
+        return yahoo_frame(dates, 10.0)
+
+    def scrape_actions(symbol, start_date, end_date):
+        return pd.DataFrame({"action": ["DIVIDEND"], "value": [1.0]},
+                            index=pd.to_datetime(["2020-01-08"]))
+
+    mf_scraper.scrape = scrape
+    mf_scraper.scrape_actions = scrape_actions
+
+    fund_family = {
+        "family": "F",
+        "symbols": [{"symbol": "A", "name": "A fund", "fund_family": "F"}],
+    }
+    df = mf_scraper.get_symbol_prices(fund_family)
+
+    assert "adj_close" in df.columns
+    before = df[df["date"] < "2020-01-08"]
+    assert (before["adj_close"] == 9.0).all()
+    assert (df[df["date"] >= "2020-01-08"]["adj_close"] == 10.0).all()
+
+
+def test_splits_do_not_adjust_close(tmp_path):
+    dates = pd.date_range("2020-01-01", periods=10)
+    mf_scraper = MFScraper(
+        str(tmp_path / "mf.sqlite"), "yahoo", str(tmp_path / "cache"), 7,
+        datetime.date(2020, 1, 1), datetime.date(2020, 1, 10), adjusted=True,
+    )
+    mf_scraper.scrape = lambda *args: yahoo_frame(dates, 10.0)
+    mf_scraper.scrape_actions = lambda *args: pd.DataFrame(
+        {"action": ["SPLIT"], "value": [0.5]},
+        index=pd.to_datetime(["2020-01-08"]))
+
+    fund_family = {
+        "family": "F",
+        "symbols": [{"symbol": "A", "name": "A fund", "fund_family": "F"}],
+    }
+    df = mf_scraper.get_symbol_prices(fund_family)
+
+    assert (df["adj_close"] == df["close"]).all()
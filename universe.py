@@ -0,0 +1,62 @@
+# coding: utf8
+import hashlib
+
+
+def page_hash(content):
+    if content is None:
+        return None
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha1(content).hexdigest()
+
+
+def symbol_keys(fund_families):
+    keys = set()
+    for key, ff in fund_families.items():
+        for s in ff.get("symbols") or []:
+            keys.add((key, s["symbol"]))
+    return keys
+
+
+def merge_universe(previous, current, complete):
+    """The full universe after a (possibly `limit`ed) discovery run.
+
+    Families outside of the run are carried over from `previous`, unless
+    the run covered every family, in which case missing ones are gone.
+    """
+    merged = dict()
+    if not complete:
+        for key, ff in previous.items():
+            if key not in current:
+                merged[key] = ff
+    for key, ff in current.items():
+        merged[key] = ff
+    return merged
+
+
+def diff_universe(previous, current):
+    """Added and removed (fund_family, symbol) pairs between two versions."""
+    old = symbol_keys(previous)
+    new = symbol_keys(current)
+
+    changed = []
+    for key, ff in current.items():
+        prev = previous.get(key)
+        if prev is None:
+            changed.append(key)
+            continue
+        hashes = ("family_hash", "fund_page_hash", "fund_page")
+        if any(prev.get(h) != ff.get(h) for h in hashes):
+            changed.append(key)
+    removed_families = [k for k in previous if k not in current]
+
+    return {
+        "added": sorted(new - old),
+        "removed": sorted(old - new),
+        "changed_families": sorted(changed),
+        "removed_families": sorted(removed_families),
+    }
+
+
+def is_unchanged(diff):
+    return not any(diff.values())
@@ -1,8 +1,6 @@
 # coding: utf8
 import datetime
 from json.decoder import JSONDecodeError
-import pandas as pd
-import pandas_datareader as pdr
 import pickle
 import os
 
@@ -28,6 +26,8 @@ def pickle_path(url):
     )
 
 def get_tingo_weekly(symbol):
+    import pandas_datareader as pdr
+
     try:
         df = pdr.get_data_tiingo(symbol, api_key=TINGO_API_KEY)
     except JSONDecodeError:
@@ -36,6 +36,8 @@ def get_tingo_weekly(symbol):
 
 def df_weekly_to_quarterly(df, date_column, addional_indexes=["symbol"],
                            stats_cols=["close"]):
+	import pandas as pd
+
     #df.reset_index(inplace=True)
     #df.set_index(index, inplace=True)
 
@@ -61,6 +63,14 @@ def pickled_page_exists(url):
     fn = pickle_path(url)
     return os.path.exists(fn)
 
+def pickled_page_age(url):
+    """How long ago `url` was downloaded, None if it never was."""
+    fn = pickle_path(url)
+    if not os.path.exists(fn):
+        return None
+    modified = datetime.datetime.fromtimestamp(os.path.getmtime(fn))
+    return datetime.datetime.now() - modified
+
 def load_pickled_page(url):
     fn = pickle_path(url)
     with open(fn, "rb") as f:
@@ -68,11 +78,10 @@ def load_pickled_page(url):
     return data
 
 def get_start_and_end_dates():
-    """For consistent caching"""
+    """End on the latest published NAV, so caching is consistent per
+    trading day rather than per calendar day."""
+    from market_calendar import latest_nav_date
 
-    today = datetime.datetime.now().date()
-    dow = today.weekday()
-    end_date = today - datetime.timedelta(days=dow)
+    end_date = latest_nav_date()
     start_date = START_DATE
     return (start_date, end_date)
-